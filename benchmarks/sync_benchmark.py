@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+"""Offline sync benchmark.
+
+Runs main.download_songs end to end against a local stand-in for the Web API,
+lyrics and image hosts, with a fake librespot content feeder serving
+synthetic Ogg Vorbis files. Every library size runs in its own process so the
+peak RSS of one size does not leak into the next.
+
+    python benchmarks/sync_benchmark.py --sizes 100 1000 10000 --workers 4
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+FAKE_HOSTS = (
+    "https://api.spotify.com",
+    "https://spclient.wg.spotify.com",
+    "https://i.scdn.co",
+)
+
+TRACKS_PER_ALBUM = 10
+
+TRACKS_PER_ARTIST = 25
+
+AUDIO_PACKET_SIZE = 4000
+
+PACKETS_PER_PAGE = 15
+
+PLAYLIST_SIZE = 100
+
+FOLLOWED_ARTIST_EVERY = 4
+
+
+def base62_id(n: int) -> str:
+    digits = []
+    while n:
+        n, r = divmod(n, 62)
+        digits.append(BASE62[r])
+    return "".join(reversed(digits)).rjust(22, "0")
+
+
+def _crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else r << 1
+        table.append(r & 0xFFFFFFFF)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def ogg_crc(data: bytes) -> int:
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[((crc >> 24) ^ b) & 0xFF]
+    return crc
+
+
+def ogg_page(packets, granule, serial, seqno, header_type=0) -> bytes:
+    lacing = []
+    for packet in packets:
+        lacing += [255] * (len(packet) // 255) + [len(packet) % 255]
+    header = struct.pack(
+        "<4sBBqIIIB", b"OggS", 0, header_type, granule, serial, seqno, 0, len(lacing)
+    )
+    page = header + bytes(lacing) + b"".join(packets)
+    crc = ogg_crc(page)
+    return page[:22] + struct.pack("<I", crc) + page[26:]
+
+
+def synthetic_ogg_vorbis(size: int, seed: int = 0) -> bytes:
+    # Real Vorbis headers around random audio packets: enough for the copy
+    # fast path and for mutagen to tag, nothing here is decodable audio.
+    serial = 0x5EED
+    rate = 44100
+    identification = b"\x01vorbis" + struct.pack(
+        "<IBIiiiBB", 0, 2, rate, 0, 160000, 0, 0xB8, 1
+    )
+    vendor = b"spotiloader benchmark"
+    comment = b"\x03vorbis" + struct.pack("<I", len(vendor)) + vendor
+    comment += struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + bytes(64)
+    pages = [
+        ogg_page([identification], 0, serial, 0, 0x02),
+        ogg_page([comment, setup], 0, serial, 1),
+    ]
+    rng = random.Random(seed)
+    written = sum(len(page) for page in pages)
+    granule = 0
+    while written < size:
+        packets = [rng.randbytes(AUDIO_PACKET_SIZE) for _ in range(PACKETS_PER_PAGE)]
+        granule += 1024 * len(packets)
+        last = written + len(packets) * AUDIO_PACKET_SIZE >= size
+        pages.append(ogg_page(packets, granule, serial, len(pages), 0x04 * last))
+        written += len(pages[-1])
+    return b"".join(pages)
+
+
+def jpeg_artwork(size: int = 300) -> bytes:
+    from PIL import Image
+
+    image = Image.new("RGB", (size, size), (30, 215, 96))
+    data = io.BytesIO()
+    image.save(data, "JPEG")
+    return data.getvalue()
+
+
+def build_library(count: int, relookup: float) -> list[dict]:
+    rng = random.Random(count)
+    items = []
+    for i in range(count):
+        track_id = base62_id(i + 1)
+        artist = i // TRACKS_PER_ARTIST
+        album = i // TRACKS_PER_ALBUM
+        track = {
+            "id": track_id,
+            "name": f"Track {i}",
+            "artists": [{"id": base62_id(10**9 + artist), "name": f"Artist {artist}"}],
+            "album": {
+                "name": f"Album {album}",
+                "release_date": f"{2000 + album % 25}-01-01",
+                "images": [{"url": f"https://i.scdn.co/image/{album}", "width": 300}],
+            },
+            "disc_number": 1,
+            "track_number": i % TRACKS_PER_ALBUM + 1,
+            "duration_ms": 180000,
+            "is_playable": True,
+        }
+        items.append(
+            {
+                "added_at": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(2000000000 - i * 60)
+                ),
+                # Some tracks come back incomplete and are looked up again
+                # through /v1/tracks, like relinked tracks do.
+                "track": (
+                    {k: v for k, v in track.items() if k != "is_playable"}
+                    if rng.random() < relookup
+                    else track
+                ),
+                "full_track": track,
+            }
+        )
+    return items
+
+
+def build_playlists(library: list[dict]) -> dict[str, list[dict]]:
+    # Playlists overlap with each other and with the saved tracks, like real
+    # ones do, so the sources have duplicates to drop.
+    rng = random.Random(len(library))
+    return {
+        base62_id(2 * 10**9 + p): rng.sample(library, min(PLAYLIST_SIZE, len(library)))
+        for p in range(max(1, len(library) // PLAYLIST_SIZE))
+    }
+
+
+def build_discography(library: list[dict]) -> tuple[list, dict, dict]:
+    by_name = {}
+    for item in library:
+        track = item["full_track"]
+        by_name.setdefault(track["album"]["name"], []).append(track)
+    albums = {
+        base62_id(3 * 10**9 + i): tracks for i, tracks in enumerate(by_name.values())
+    }
+    artist_albums = {}
+    for album_id, tracks in albums.items():
+        artist_albums.setdefault(tracks[0]["artists"][0]["id"], []).append(album_id)
+    followed = list(artist_albums)[::FOLLOWED_ARTIST_EVERY]
+    return followed, artist_albums, albums
+
+
+def make_handler(library: list[dict], artwork: bytes, latency: float):
+    by_id = {item["full_track"]["id"]: item["full_track"] for item in library}
+    saved = [{"added_at": item["added_at"], "track": item["track"]} for item in library]
+    playlists = build_playlists(library)
+    followed, artist_albums, albums = build_discography(library)
+    lyrics = {
+        "lyrics": {
+            "syncType": "LINE_SYNCED",
+            "lines": [
+                {"startTimeMs": str(i * 4000), "words": f"Line {i}"} for i in range(40)
+            ],
+        }
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, body: bytes, content_type="application/json", status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            parts = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+            ids = query.get("ids", "").split(",")
+            if parts.path == "/v1/me/tracks":
+                offset = int(query.get("offset", 0))
+                limit = int(query.get("limit", 20))
+                body = {"items": saved[offset : offset + limit], "total": len(saved)}
+            elif parts.path == "/v1/me/playlists":
+                offset = int(query.get("offset", 0))
+                limit = int(query.get("limit", 20))
+                body = {
+                    "items": [
+                        {
+                            "id": id,
+                            "snapshot_id": "1",
+                            "tracks": {"total": len(playlists[id])},
+                        }
+                        for id in list(playlists)[offset : offset + limit]
+                    ],
+                    "total": len(playlists),
+                }
+            elif parts.path.startswith("/v1/playlists/"):
+                offset = int(query.get("offset", 0))
+                limit = int(query.get("limit", 20))
+                items = playlists[parts.path.split("/")[3]]
+                body = {
+                    "items": [
+                        {"added_at": item["added_at"], "track": item["full_track"]}
+                        for item in items[offset : offset + limit]
+                    ],
+                    "total": len(items),
+                }
+            elif parts.path == "/v1/me/following":
+                limit = int(query.get("limit", 20))
+                start = followed.index(query["after"]) + 1 if "after" in query else 0
+                page = followed[start : start + limit]
+                more = start + limit < len(followed)
+                body = {
+                    "artists": {
+                        "items": [{"id": id} for id in page],
+                        "cursors": {"after": page[-1] if more else None},
+                        "total": len(followed),
+                    }
+                }
+            elif parts.path.startswith("/v1/artists/"):
+                offset = int(query.get("offset", 0))
+                limit = int(query.get("limit", 20))
+                items = artist_albums[parts.path.split("/")[3]]
+                body = {
+                    "items": [{"id": id} for id in items[offset : offset + limit]],
+                    "total": len(items),
+                }
+            elif parts.path == "/v1/albums":
+                body = {
+                    "albums": [
+                        {
+                            "id": id,
+                            "name": albums[id][0]["album"]["name"],
+                            "release_date": albums[id][0]["album"]["release_date"],
+                            "images": albums[id][0]["album"]["images"],
+                            "tracks": {
+                                "items": [
+                                    {k: v for k, v in track.items() if k != "album"}
+                                    for track in albums[id]
+                                ],
+                                "next": None,
+                            },
+                        }
+                        for id in ids
+                    ]
+                }
+            elif parts.path == "/v1/tracks":
+                body = {"tracks": [by_id.get(id) for id in ids]}
+            elif parts.path == "/v1/artists":
+                body = {
+                    "artists": [
+                        {"id": id, "genres": ["benchmark", "synthetic"]} for id in ids
+                    ]
+                }
+            elif parts.path.startswith("/color-lyrics/v2/track/"):
+                body = lyrics
+            elif parts.path.startswith("/image/"):
+                self.send(artwork, "image/jpeg")
+                return
+            else:
+                self.send(b"{}", status=404)
+                return
+            self.send(json.dumps(body).encode())
+
+    return Handler
+
+
+class LocalAdapter(HTTPAdapter):
+    """Sends requests for the Spotify hosts to the local server instead."""
+
+    def __init__(self, netloc: str):
+        super().__init__(pool_maxsize=16)
+        self.netloc = netloc
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = urlunsplit(("http", self.netloc, parts.path, parts.query, ""))
+        return super().send(request, **kwargs)
+
+
+class FakeStream:
+    def __init__(self, data: bytes, bandwidth: float):
+        self._data = data
+        self._pos = 0
+        self._bandwidth = bandwidth
+
+    def pos(self) -> int:
+        return self._pos
+
+    def seek(self, where: int) -> None:
+        self._pos = where
+
+    def read(self, n: int) -> bytes:
+        data = self._data[self._pos : self._pos + n]
+        self._pos += len(data)
+        if self._bandwidth:
+            time.sleep(len(data) / self._bandwidth)
+        return data
+
+
+class FakeInputStream:
+    def __init__(self, data: bytes, bandwidth: float):
+        self.size = len(data)
+        self._stream = FakeStream(data, bandwidth)
+
+    def stream(self) -> FakeStream:
+        return self._stream
+
+
+class FakeSession:
+    """Stands in for a librespot session, only the content feeder is used."""
+
+    def __init__(self, data: bytes, bandwidth: float, latency: float):
+        self._data = data
+        self._bandwidth = bandwidth
+        self._latency = latency
+
+    def content_feeder(self):
+        return self
+
+    def is_valid(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+    def load(self, content_id, quality, preload, halt_listener):
+        # Storage resolve and audio key are a few round trips to the access
+        # point before the first byte comes from the CDN.
+        if self._latency:
+            time.sleep(self._latency)
+        return SimpleNamespace(
+            input_stream=FakeInputStream(self._data, self._bandwidth)
+        )
+
+
+class FakeSessionPool:
+    def __init__(self, session: FakeSession):
+        self._session = session
+
+    def run(self, fn):
+        return fn(self._session)
+
+    def close(self) -> None:
+        pass
+
+
+def run_size(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="spotiloader-bench-")
+    os.environ["XDG_CONFIG_HOME"] = os.path.join(workdir, "config")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(workdir, "cache")
+    os.makedirs(os.path.join(workdir, "config", "spotiloader"))
+
+    import main
+    from spoti_loader import client, metrics
+    from spoti_loader.fsindex import get_output_index, close_output_indexes
+    from spoti_loader.lyrics import configure_lyrics_fetcher, close_lyrics_fetcher
+    from spoti_loader.store import close_download_log
+    from spoti_loader.template import configure_output_template
+    from spoti_loader.postprocess import configure_postprocessor, close_postprocessor
+
+    if not args.verbose:
+        logging.getLogger("main").setLevel(logging.WARNING)
+        logging.getLogger("spoti_loader").setLevel(logging.WARNING)
+
+    library = build_library(args.size, args.relookup)
+    handler = make_handler(library, jpeg_artwork(), args.api_latency)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    adapter = LocalAdapter(f"127.0.0.1:{server.server_address[1]}")
+    for host in FAKE_HOSTS:
+        client.get_session().mount(host, adapter)
+
+    audio = synthetic_ogg_vorbis(args.track_kib * 1024)
+    sessions = FakeSessionPool(
+        FakeSession(audio, args.bandwidth_kib * 1024, args.stream_latency)
+    )
+    output = os.path.join(workdir, "music")
+    os.makedirs(output)
+    try:
+        get_output_index(output)
+        configure_output_template(args.output_template)
+        configure_postprocessor(workers=args.postprocess_workers)
+        configure_lyrics_fetcher(args.lyrics_workers, 30)
+        start = time.perf_counter()
+        downloaded, errors = main.download_songs(
+            sessions, "benchmark-token", output, args.workers, True, args.sources
+        )
+        # Lyrics still in flight belong to the sync, so they are waited for.
+        close_lyrics_fetcher()
+        wall = time.perf_counter() - start
+    finally:
+        close_lyrics_fetcher()
+        close_postprocessor()
+        close_output_indexes()
+        close_download_log()
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    completed = sum(1 for song in downloaded if song is not None)
+    return {
+        "tracks": args.size,
+        "downloaded": completed,
+        "failed": len(downloaded) - completed,
+        "errors": len(errors),
+        "wall_time": wall,
+        "tracks_per_sec": completed / wall if wall else 0.0,
+        # ru_maxrss is in KiB on Linux. The post-processing workers were reaped
+        # when the pool closed, RUSAGE_CHILDREN holds the largest of them.
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_worker_rss": (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        ),
+        "stages": metrics.get_report()["stages"],
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a sync without network.")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="library sizes to run, one process each",
+    )
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--lyrics-workers", type=int, default=2)
+    parser.add_argument(
+        "--track-kib", type=int, default=128, help="size of each synthetic track"
+    )
+    parser.add_argument(
+        "--bandwidth-kib",
+        type=float,
+        default=0,
+        help="stream bandwidth per track in KiB/s, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--stream-latency",
+        type=float,
+        default=0.05,
+        help="seconds before a stream starts, like storage resolve and audio key",
+    )
+    parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0.02,
+        help="seconds added to every fake Web API, lyrics and image response",
+    )
+    parser.add_argument(
+        "--relookup",
+        type=float,
+        default=0.1,
+        help="share of saved tracks that need a /v1/tracks lookup",
+    )
+    parser.add_argument(
+        "--sources",
+        nargs="+",
+        default=["saved"],
+        help="sync sources to list, any of saved, playlists and artists",
+    )
+    parser.add_argument(
+        "--output-template",
+        default="{artist} - {song_name}.{ext}",
+        help="output template the tracks are written to",
+    )
+    parser.add_argument(
+        "--postprocess-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes that tag the tracks, 0 tags them in the download threads",
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    parser.add_argument("--verbose", action="store_true", help="keep the sync logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.size is not None:
+        print(json.dumps(run_size(args)))
+        return
+    child_args = []
+    for name in (
+        "workers",
+        "lyrics_workers",
+        "track_kib",
+        "bandwidth_kib",
+        "stream_latency",
+        "api_latency",
+        "relookup",
+        "output_template",
+        "postprocess_workers",
+    ):
+        child_args += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    child_args += ["--sources"] + args.sources
+    for name in ("keep", "verbose"):
+        if getattr(args, name):
+            child_args.append(f"--{name}")
+    results = []
+    for size in args.sizes:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--size", str(size)]
+            + child_args,
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        results.append(json.loads(completed.stdout.decode().splitlines()[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(
+        f"{'tracks':>8} {'done':>8} {'wall (s)':>10} {'tracks/s':>10} "
+        f"{'peak RSS (MiB)':>15} {'worker RSS (MiB)':>17}"
+    )
+    for result in results:
+        print(
+            f"{result['tracks']:>8} {result['downloaded']:>8} "
+            f"{result['wall_time']:>10.2f} {result['tracks_per_sec']:>10.1f} "
+            f"{result['peak_rss'] / 1024 / 1024:>15.1f} "
+            f"{result['peak_worker_rss'] / 1024 / 1024:>17.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
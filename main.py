@@ -1,28 +1,74 @@
 #!/usr/bin/env python3
+import argparse
 import json
 import os
 import logging
+import random
+import signal
 import sys
-import sqlite3
-import requests
-from pathlib import PurePath, Path
-from librespot.audio.decoders import AudioQuality
-from librespot.core import Session
+import threading
+import time
+
+IMPORT_START = time.perf_counter()
+
+from contextlib import contextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from pathlib import PurePath
 from spoti_loader.const import (
     USER_READ_EMAIL,
     PLAYLIST_READ_PRIVATE,
     USER_LIBRARY_READ,
     USER_FOLLOW_READ,
-    SAVED_TRACKS_URL,
-    ITEMS,
     TRACK,
     NAME,
     ID,
-    ARTISTS,
+    ADDED_AT,
+    DEFAULT_FORMAT,
+    CODEC_MAP,
     EXT_MAP,
 )
-from spoti_loader.utils import invoke_url_with_params, get_log_db, fix_filename
+from spoti_loader.utils import prefetch, write_atomic
 from spoti_loader.downloader import download_track
+from spoti_loader.metadata import resolve_tracks
+from spoti_loader.planner import Plan, MISSING
+from spoti_loader.template import configure_output_template, DEFAULT_OUTPUT_TEMPLATE
+from spoti_loader.postprocess import (
+    configure_postprocessor,
+    get_postprocessor,
+    close_postprocessor,
+)
+from spoti_loader.sources import (
+    LibrarySources,
+    SAVED_SOURCE,
+    SOURCES,
+    DEFAULT_PAGE_WORKERS,
+)
+from spoti_loader.store import get_download_log, close_download_log
+from spoti_loader.artwork import configure_artwork_cache
+from spoti_loader.fsindex import get_output_index, close_output_indexes
+from spoti_loader.artists import configure_artist_cache, get_artist_cache
+from spoti_loader.lyrics import (
+    configure_lyrics_fetcher,
+    get_lyrics_fetcher,
+    get_lyrics_filename,
+    close_lyrics_fetcher,
+)
+from spoti_loader.notifier import (
+    configure_notifier,
+    notify,
+    close_notifier,
+    DOWNLOADED,
+    ERROR,
+    REPORT,
+)
+from spoti_loader.sessions import SessionPool
+from spoti_loader.auth import TokenProvider
+from spoti_loader import client, metrics
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +77,9 @@ formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
+package_logger = logging.getLogger("spoti_loader")
+package_logger.addHandler(handler)
+package_logger.setLevel(logging.INFO)
 
 
 def fatalf(msg, *args):
@@ -38,6 +87,18 @@ def fatalf(msg, *args):
     sys.exit(1)
 
 
+timings = []
+
+
+@contextmanager
+def timed(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((phase, time.perf_counter() - start))
+
+
 def get_cred_file():
     xdg_config_home = os.getenv("XDG_CONFIG_HOME")
     if xdg_config_home is None:
@@ -45,17 +106,60 @@ def get_cred_file():
     return os.path.join(xdg_config_home, "spotiloader", "config.json")
 
 
-def load_json_file(filepath: str) -> tuple[str, str, str, str] | None:
+def get_status_file():
+    return os.path.join(os.path.dirname(get_cred_file()), "status.json")
+
+
+CONFIG_DEFAULTS = {
+    "discord": None,
+    "workers": 1,
+    "incremental": True,
+    "full_sync_days": 7,
+    "artwork_cache_mb": 256,
+    "artwork_max_size": None,
+    "persist_file_index": False,
+    "artist_cache_days": 30,
+    "lyrics_workers": 2,
+    "lyrics_retry_days": 30,
+    "sessions": 1,
+    "metrics_json": None,
+    "metrics_prometheus": None,
+    "discord_metrics": False,
+    "sources": [SAVED_SOURCE],
+    "page_workers": DEFAULT_PAGE_WORKERS,
+    "poll_interval_minutes": 60,
+    "poll_jitter_minutes": 5,
+    "status_file": None,
+    "output_template": DEFAULT_OUTPUT_TEMPLATE,
+    "format": DEFAULT_FORMAT,
+    "postprocess_workers": None,
+}
+
+SAVED_TRACKS_CURSOR = "saved_tracks_cursor"
+
+LAST_FULL_SYNC = "last_full_sync"
+
+
+def load_json_file(filepath: str) -> dict | None:
     try:
         with open(filepath, "r") as f:
             data = json.load(f)
-        username = data.get("username")
-        password = data.get("password")
-        output = data.get("output")
-        discord = data.get("discord")
-        if not username or not password or not output:
+        if not all(data.get(key) for key in ("username", "password", "output")):
             raise ValueError("Username/password/output is missing or empty.")
-        return username, password, output, discord
+        config = {**CONFIG_DEFAULTS, **data}
+        for key in ("workers", "sessions", "page_workers"):
+            config[key] = int(config[key])
+            if config[key] < 1:
+                raise ValueError(f"{key} must be at least 1.")
+        if config["format"] not in CODEC_MAP:
+            raise ValueError(
+                f"Unknown format: {config['format']}, "
+                f"expected one of {', '.join(CODEC_MAP)}."
+            )
+        unknown = set(config["sources"]) - set(SOURCES)
+        if unknown:
+            raise ValueError(f"Unknown sources: {', '.join(sorted(unknown))}.")
+        return config
     except FileNotFoundError:
         fatalf(f"File {filepath} not found.")
         return None
@@ -64,115 +168,394 @@ def load_json_file(filepath: str) -> tuple[str, str, str, str] | None:
         return None
 
 
-username, password, output, discord = load_json_file(get_cred_file())
-output = os.path.expanduser(output)
-quality = AudioQuality.HIGH
-conf = Session.Configuration.Builder().set_store_credentials(False).build()
-session = Session.Builder(conf).user_pass(username, password).create()
-token = (
-    session.tokens()
-    .get_token(
-        USER_READ_EMAIL, PLAYLIST_READ_PRIVATE, USER_LIBRARY_READ, USER_FOLLOW_READ
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download your Spotify library.")
+    parser.add_argument(
+        "--full-sync",
+        action="store_true",
+        help="page through the whole library instead of stopping at the last sync",
     )
-    .access_token
-)
+    parser.add_argument(
+        "--lyrics-backfill",
+        action="store_true",
+        help="only fetch missing lyrics for songs that were already downloaded",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="list the whole library and print what a full sync would do",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and sync again every poll_interval_minutes",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="log how long startup and each phase of the run took",
+    )
+    return parser.parse_args(argv)
 
 
-def get_saved_tracks() -> list:
-    songs = []
-    offset = 0
-    limit = 50
-    while True:
-        resp = invoke_url_with_params(
-            token, SAVED_TRACKS_URL, limit=limit, offset=offset
+def session_factory(username: str, password: str):
+    def create_session():
+        # librespot pulls in protobuf and friends, it is only imported once a
+        # session is really needed.
+        from librespot.core import Session
+
+        with timed("login"):
+            conf = Session.Configuration.Builder().set_store_credentials(False).build()
+            return Session.Builder(conf).user_pass(username, password).create()
+
+    return create_session
+
+
+def needs_full_sync(config: dict, force: bool = False) -> bool:
+    if force or not config["incremental"]:
+        return True
+    download_log = get_download_log()
+    if download_log.get_state(SAVED_TRACKS_CURSOR) is None:
+        return True
+    last_full_sync = download_log.get_state(LAST_FULL_SYNC)
+    if last_full_sync is None:
+        return True
+    return time.time() - float(last_full_sync) >= config["full_sync_days"] * 86400
+
+
+def download_song(
+    sessions, token, output: str, song, info, transfers=None
+) -> str | None:
+    with metrics.timed("track"):
+        songtitle = download_track(
+            sessions, token, output, song[TRACK][ID], info, transfers
         )
-        offset += limit
-        songs.extend(resp[ITEMS])
-        if len(resp[ITEMS]) < limit:
-            break
-    return songs
-
-
-def send_to_discord(webhook_url, title, content, color=2605644):
-    headers = {"Content-Type": "application/json"}
-
-    data = {
-        "content": None,
-        "embeds": [{"title": title, "description": content, "color": color}],
-    }
-    requests.post(webhook_url, headers=headers, data=json.dumps(data))
-
-
-def send_discord_notifications(songs, errors):
-    songs = [song for song in songs if song is not None]
-    errors = [error for error in errors if error is not None]
-    for i in range(0, len(songs), 20):
-        batch_songs = songs[i : i + 20]
-        if len(batch_songs) > 0:
-            succes_title = "**Downloaded songs : **"
-            count_msg = f"{len(batch_songs)} tracks successfully downloaded"
-            batch_songs.insert(0, count_msg)
-            batch_songs.insert(0, succes_title)
-            batch_songs.insert(0, "@everyone")
-            success_message = "\n".join(batch_songs)
-            send_to_discord(discord, "SpotiLoader Downloads", success_message)
-    for i in range(0, len(errors), 20):
-        batch_errors = errors[i : i + 20]
-        if len(batch_errors) > 0:
-            errormsg = "**Errors when downloading songs : **"
-            batch_errors.insert(0, "@everyone")
-            batch_errors.insert(0, errormsg)
-            error_message = "\n".join(batch_errors)
-            send_to_discord(discord, "SpotiLoader Errors", error_message, 16753920)
-
-
-def song_previously_downloaded(song_id: str) -> bool:
-    conn = sqlite3.connect(get_log_db())
-    cursor = conn.cursor()
-    cursor.execute("SELECT EXISTS (SELECT 1 FROM songs WHERE id = ?);", (song_id,))
-    result = cursor.fetchone()
-
-    # Close the database connection
-    conn.close()
-
-    # Return True if the song_id exists, False otherwise
-    return result[0] == 1
-
-
-def download_songs() -> tuple[list, list]:
+    if songtitle is not None:
+        logger.info(f"Downloaded {song[TRACK][NAME]}")
+        notify(DOWNLOADED, songtitle)
+    return songtitle
+
+
+def download_songs(
+    sessions,
+    token,
+    output: str,
+    workers: int,
+    full_sync: bool,
+    sources=(SAVED_SOURCE,),
+    page_workers: int = DEFAULT_PAGE_WORKERS,
+    stop: threading.Event = None,
+) -> tuple[list, list]:
     errors = []
     downloaded = []
-    for song in get_saved_tracks():
-        if song[TRACK][NAME] and song[TRACK][ID]:
-            logger.info(f"Checking {song[TRACK][NAME]}")
-            output_template = "{artist} - {song_name}.{ext}"
-            ext = EXT_MAP.get("ogg")
-            output_template = output_template.replace(
-                "{artist}", fix_filename(song[TRACK][ARTISTS][0][NAME])
-            )
-            output_template = output_template.replace(
-                "{song_name}", fix_filename(song[TRACK][NAME])
-            )
-            output_template = output_template.replace("{ext}", ext)
-            filename = PurePath(output).joinpath(output_template)
-            check_name = Path(filename).is_file() and Path(filename).stat().st_size
-            check_id = song_previously_downloaded(song[TRACK][ID])
-            if check_id and check_name:
-                logger.info(f"Skipping {song[TRACK][NAME]}")
-                continue
+    download_log = get_download_log()
+    since = None if full_sync else download_log.get_state(SAVED_TRACKS_CURSOR)
+    library = LibrarySources(token, download_log, page_workers, full_sync)
+    # Every source goes through the same plan, so a track that is saved and in
+    # a few playlists is still downloaded once.
+    plan = Plan(download_log, get_output_index(output), output)
+    newest = None
+
+    def collect(future, song):
+        try:
+            downloaded.append(future.result())
+        except Exception as e:
+            errors.append(e)
+            logger.error(f"Error when downloading {song[TRACK][NAME]}")
+            logger.error(e)
+            notify(ERROR, f"{song[TRACK][NAME]}: {e}")
+
+    # workers tracks stream at a time. The other threads wait on the
+    # post-processing pool, which blocks them once it is full, so transfers
+    # only run ahead of encoding by its queue.
+    transfers = threading.Semaphore(workers)
+    threads = workers + get_postprocessor().capacity
+    # Pages are fetched one ahead of the download stage and at most
+    # max_in_flight tracks are queued, so memory does not grow with the library.
+    max_in_flight = threads * 2
+    futures = {}
+    with library, ThreadPoolExecutor(max_workers=threads) as executor:
+        for source, page in prefetch(library.pages(sources, since)):
+            if stop is not None and stop.is_set():
+                break
+            if source == SAVED_SOURCE:
+                page_newest = max(song[ADDED_AT] for song in page)
+                if newest is None or page_newest > newest:
+                    newest = page_newest
+            pending = plan.add(page)
+            # The saved tracks payload usually carries everything download_track
+            # needs, only the incomplete ones are looked up again in one request.
             try:
-                songtitle = download_track(session, token, output, song[TRACK][ID])
-                if songtitle is not None:
-                    logger.info(f"Downloaded {song[TRACK][NAME]}")
-                downloaded.append(songtitle)
+                with metrics.timed("resolve_tracks"):
+                    infos = resolve_tracks(
+                        token, [entry.song[TRACK] for entry in pending]
+                    )
             except Exception as e:
-                errors.append(e)
-                logger.error(f"Error when downloading {song[TRACK][NAME]}")
-                logger.error(e)
+                # download_track looks each track of the page up on its own.
+                logger.error(f"Failed to resolve tracks: {e}")
+                infos = {}
+            # Genres of every artist on the page are looked up together, 50 per
+            # request, instead of once per track and artist.
+            try:
+                with metrics.timed("artist_prefetch"):
+                    get_artist_cache().prefetch(
+                        token,
+                        [
+                            artist[ID]
+                            for info in infos.values()
+                            for artist in info.raw_artists
+                            if artist.get(ID)
+                        ],
+                    )
+            except Exception as e:
+                logger.error(f"Failed to fetch artist genres: {e}")
+            for entry in pending:
+                while len(futures) >= max_in_flight:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future, futures.pop(future))
+                if stop is not None and stop.is_set():
+                    break
+                if entry.status == MISSING:
+                    # Its file is gone, download_track must not consider the
+                    # song done just because another file took the name.
+                    download_log.remove(entry.track_id)
+                info = infos.get(entry.track_id)
+                future = executor.submit(
+                    download_song, sessions, token, output, entry.song, info, transfers
+                )
+                futures[future] = entry.song
+        if stop is not None and stop.is_set():
+            # Only the tracks already streaming are worth waiting for, the
+            # queued ones would outlast the service manager's stop timeout.
+            futures = {
+                future: song for future, song in futures.items() if not future.cancel()
+            }
+        for future in as_completed(futures):
+            collect(future, futures[future])
+    logger.info(f"{'Full' if full_sync else 'Incremental'} sync: {plan.summary()}")
+    if stop is not None and stop.is_set():
+        # Pages after the one it stopped on were never looked at, moving the
+        # cursor past them would skip their tracks for good.
+        logger.info("Sync interrupted, it continues from the same point next time")
+        return downloaded, errors
+    # A failed download would be skipped by the next incremental sync, so the
+    # cursor only moves forward after an error free run.
+    if not errors:
+        if newest:
+            download_log.set_state(SAVED_TRACKS_CURSOR, newest)
+        library.commit()
+    if full_sync:
+        removed = len(plan.orphaned())
+        if removed:
+            logger.info(f"{removed} downloaded songs are no longer in the library")
+        download_log.set_state(LAST_FULL_SYNC, str(time.time()))
     return downloaded, errors
 
 
-downloaded, errors = download_songs()
+def plan_songs(
+    token, output: str, sources=(SAVED_SOURCE,), page_workers=DEFAULT_PAGE_WORKERS
+) -> Plan:
+    plan = Plan(get_download_log(), get_output_index(output), output)
+    with LibrarySources(token, get_download_log(), page_workers) as library:
+        for _, page in prefetch(library.pages(sources)):
+            plan.add(page)
+    return plan
+
+
+def backfill_lyrics(token, output: str) -> int:
+    download_log = get_download_log()
+    output_index = get_output_index(output)
+    lyrics_fetcher = get_lyrics_fetcher()
+    futures = []
+    for song_id, filename in download_log.songs():
+        lyrics_filename = get_lyrics_filename(PurePath(output).joinpath(filename))
+        if output_index.has_file(lyrics_filename):
+            continue
+        if not lyrics_fetcher.should_fetch(song_id):
+            continue
+        futures.append(
+            lyrics_fetcher.submit(token, song_id, lyrics_filename, output_index)
+        )
+    return sum(1 for future in futures if future.result())
+
+
+def report_run(config: dict, send_report=True) -> None:
+    report = metrics.get_report()
+    for path, write in (
+        (config["metrics_json"], metrics.write_json),
+        (config["metrics_prometheus"], metrics.write_prometheus),
+    ):
+        if path:
+            try:
+                write(path, report)
+            except OSError as e:
+                logger.error(f"Failed to write metrics to {path}: {e}")
+
+    # Downloads and errors were already handed to the notifier as they happened.
+    if config["discord_metrics"] and send_report:
+        notify(REPORT, metrics.format_report(report))
+
+    for line in client.format_stats():
+        logger.info(line)
+    for line in metrics.format_report(report):
+        logger.info(line)
+
+
+def write_status(path: str, **status) -> None:
+    try:
+        write_atomic(path, json.dumps({"pid": os.getpid(), **status}, indent=2))
+    except OSError as e:
+        logger.error(f"Failed to write status to {path}: {e}")
+
+
+def run_daemon(args, config: dict, sessions, token, output: str) -> None:
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        logger.info("Stopping once the tracks in flight are done")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    status_file = config["status_file"] or get_status_file()
+    status = {"started_at": time.time(), "runs": 0}
+    interval = config["poll_interval_minutes"] * 60
+    jitter = config["poll_jitter_minutes"] * 60
+    while not stop.is_set():
+        full_sync = needs_full_sync(config, args.full_sync and status["runs"] == 0)
+        if full_sync and status["runs"]:
+            # Files removed by hand since the last scan only show up as missing
+            # once the output directory is scanned again.
+            close_output_indexes()
+            get_output_index(output, persist=config["persist_file_index"])
+        status.update(state="syncing", run_started_at=time.time())
+        write_status(status_file, **status)
+        with timed("sync"):
+            try:
+                downloaded, errors = download_songs(
+                    sessions,
+                    token,
+                    output,
+                    config["workers"],
+                    full_sync,
+                    config["sources"],
+                    config["page_workers"],
+                    stop,
+                )
+            except Exception as e:
+                logger.error(f"Sync failed: {e}")
+                notify(ERROR, f"Sync failed: {e}")
+                downloaded, errors = [], [e]
+        # Everything stays open between runs, only what a crash would lose is
+        # written out.
+        get_output_index(output).save()
+        downloaded = [song for song in downloaded if song is not None]
+        report_run(config, send_report=bool(downloaded or errors))
+        metrics.reset()
+        client.reset_stats()
+        delay = interval + random.uniform(0, jitter)
+        status.update(
+            state="idle",
+            runs=status["runs"] + 1,
+            run_finished_at=time.time(),
+            last_full_sync=full_sync,
+            last_downloaded=len(downloaded),
+            last_errors=len(errors),
+            next_run_at=time.time() + delay,
+        )
+        write_status(status_file, **status)
+        if not stop.is_set():
+            next_run = time.strftime("%H:%M:%S", time.localtime(time.time() + delay))
+            logger.info(f"Next sync at {next_run}")
+            stop.wait(delay)
+    status.update(state="stopped", next_run_at=None)
+    write_status(status_file, **status)
+
+
+def main(argv=None):
+    timings.append(("imports", time.perf_counter() - IMPORT_START))
+    start = time.perf_counter()
+    args = parse_args(argv)
+    with timed("setup"):
+        config = load_json_file(get_cred_file())
+        output = os.path.expanduser(config["output"])
+        configure_artwork_cache(
+            int(config["artwork_cache_mb"] * 1024 * 1024), config["artwork_max_size"]
+        )
+        configure_output_template(config["output_template"], EXT_MAP[config["format"]])
+        configure_postprocessor(config["format"], config["postprocess_workers"])
+        # Nothing logs in here: the pool creates the first session when the token
+        # or a track's audio needs one, and a token saved by an earlier run is
+        # reused while it is valid.
+        sessions = SessionPool(
+            session_factory(config["username"], config["password"]),
+            config["sessions"],
+        )
+        token = TokenProvider(
+            sessions,
+            [
+                USER_READ_EMAIL,
+                PLAYLIST_READ_PRIVATE,
+                USER_LIBRARY_READ,
+                USER_FOLLOW_READ,
+            ],
+            get_download_log(),
+        )
+    try:
+        with timed("setup"):
+            get_output_index(output, persist=config["persist_file_index"])
+            configure_artist_cache(config["artist_cache_days"] * 86400)
+            configure_lyrics_fetcher(
+                config["lyrics_workers"], config["lyrics_retry_days"]
+            )
+            configure_notifier(config["discord"])
+        if args.daemon:
+            run_daemon(args, config, sessions, token, output)
+        else:
+            with timed("sync"):
+                if args.dry_run:
+                    plan = plan_songs(
+                        token, output, config["sources"], config["page_workers"]
+                    )
+                    for line in plan.format():
+                        print(line)
+                elif args.lyrics_backfill:
+                    fetched = backfill_lyrics(token, output)
+                    logger.info(f"Fetched lyrics for {fetched} songs")
+                else:
+                    download_songs(
+                        sessions,
+                        token,
+                        output,
+                        config["workers"],
+                        needs_full_sync(config, args.full_sync),
+                        config["sources"],
+                        config["page_workers"],
+                    )
+            report_run(config, send_report=not args.dry_run)
+    finally:
+        with timed("shutdown"):
+            close_lyrics_fetcher()
+            close_postprocessor()
+            sessions.close()
+            close_output_indexes()
+        # Whatever is still queued is sent, or kept in the download log for
+        # the next run.
+        with timed("notifications"):
+            close_notifier()
+        with timed("shutdown"):
+            close_download_log()
+    if args.timings:
+        timings.append(("total", time.perf_counter() - start))
+        phases = {}
+        for phase, seconds in timings:
+            phases[phase] = phases.get(phase, 0) + seconds
+        for phase, seconds in phases.items():
+            logger.info(f"{phase}: {seconds:.2f}s")
+
 
-if discord is not None:
-    send_discord_notifications(downloaded, errors)
+if __name__ == "__main__":
+    main()
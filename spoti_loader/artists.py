@@ -0,0 +1,76 @@
+import threading
+import time
+from .utils import invoke_url
+from .store import get_download_log
+from .const import *
+
+# The Several Artists endpoint accepts at most 50 comma separated IDs.
+ARTISTS_BATCH_SIZE = 50
+
+DEFAULT_TTL = 30 * 86400
+
+
+class ArtistCache:
+    def __init__(self, download_log, ttl: float = DEFAULT_TTL):
+        self.ttl = ttl
+        self._download_log = download_log
+        self._lock = threading.Lock()
+        # id -> (genres, fetched_at), expired entries count as missing so a
+        # daemon refreshes them like a new run would.
+        self._genres = {}
+
+    def prefetch(self, token, artist_ids: list[str]) -> None:
+        min_fetched_at = time.time() - self.ttl
+        with self._lock:
+            missing = [
+                id
+                for id in dict.fromkeys(artist_ids)
+                if id not in self._genres or self._genres[id][1] < min_fetched_at
+            ]
+        if not missing:
+            return
+        cached = self._download_log.get_artists(missing, min_fetched_at)
+        fetched = {}
+        missing = [id for id in missing if id not in cached]
+        for i in range(0, len(missing), ARTISTS_BATCH_SIZE):
+            batch = missing[i : i + ARTISTS_BATCH_SIZE]
+            (raw, info) = invoke_url(token, f"{ARTISTS_URL}?ids={','.join(batch)}")
+            if not ARTISTS in info:
+                raise ValueError(f"Invalid response from ARTISTS_URL:\n{raw}")
+            for artist in info[ARTISTS]:
+                if artist is not None:
+                    fetched[artist[ID]] = artist[GENRES]
+        if fetched:
+            self._download_log.save_artists(fetched)
+        now = time.time()
+        with self._lock:
+            self._genres.update(cached)
+            self._genres.update({id: (genres, now) for id, genres in fetched.items()})
+
+    def get_genres(self, token, artist_ids: list[str]) -> list[str]:
+        self.prefetch(token, artist_ids)
+        genres = []
+        with self._lock:
+            for id in artist_ids:
+                for genre in self._genres.get(id, ([], 0))[0]:
+                    if genre not in genres:
+                        genres.append(genre)
+        return genres
+
+
+_artist_cache = None
+_artist_cache_lock = threading.Lock()
+
+
+def configure_artist_cache(ttl: float) -> None:
+    global _artist_cache
+    with _artist_cache_lock:
+        _artist_cache = ArtistCache(get_download_log(), ttl)
+
+
+def get_artist_cache() -> ArtistCache:
+    global _artist_cache
+    with _artist_cache_lock:
+        if _artist_cache is None:
+            _artist_cache = ArtistCache(get_download_log())
+        return _artist_cache
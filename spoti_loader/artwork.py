@@ -0,0 +1,157 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from . import client
+
+DEFAULT_DISK_BUDGET = 256 * 1024 * 1024
+
+MEMORY_BUDGET = 32 * 1024 * 1024
+
+
+def get_cache_dir() -> str:
+    xdg_cache_home = os.getenv("XDG_CACHE_HOME")
+    if xdg_cache_home is None:
+        xdg_cache_home = os.path.expanduser("~/.cache")
+    return os.path.join(xdg_cache_home, "spotiloader", "artwork")
+
+
+def resize_artwork(data: bytes, max_size: int) -> bytes:
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_size:
+            return data
+        image.thumbnail((max_size, max_size))
+        resized = io.BytesIO()
+        image.convert("RGB").save(resized, "JPEG", quality=90)
+        return resized.getvalue()
+
+
+class ArtworkCache:
+    def __init__(
+        self,
+        path: str,
+        disk_budget: int = DEFAULT_DISK_BUDGET,
+        memory_budget: int = MEMORY_BUDGET,
+        max_size: int = None,
+    ):
+        self.path = Path(path)
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Files are touched on every hit, so their mtime gives the LRU order.
+        entries = sorted(
+            (entry for entry in os.scandir(self.path) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in entries:
+            if entry.name.endswith(".tmp"):
+                os.unlink(entry.path)
+                continue
+            self._disk[entry.name] = entry.stat().st_size
+            self._disk_bytes += entry.stat().st_size
+        self._evict_disk()
+
+    def key(self, url: str) -> str:
+        return hashlib.sha1(f"{url}|{self.max_size}".encode()).hexdigest()
+
+    def get(self, url: str) -> bytes:
+        key = self.key(url)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # Tracks of the same album usually run side by side, the per-key lock
+        # makes them wait for the first download instead of fetching it again.
+        with key_lock:
+            data = self._get_memory(key)
+            if data is None:
+                data = self._get_disk(key)
+                if data is None:
+                    response = client.get(url)
+                    # An error page cached as artwork would fail the tagging of
+                    # every track of the album until it is evicted.
+                    response.raise_for_status()
+                    data = response.content
+                    if self.max_size:
+                        data = resize_artwork(data, self.max_size)
+                    self._put_disk(key, data)
+                self._put_memory(key, data)
+            return data
+
+    def _get_memory(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+            return data
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_budget and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _get_disk(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            filename = self.path / key
+            data = filename.read_bytes()
+            os.utime(filename)
+            return data
+        except OSError:
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+    def _put_disk(self, key: str, data: bytes) -> None:
+        filename = self.path / key
+        temp_filename = self.path / f"{key}.tmp"
+        temp_filename.write_bytes(data)
+        temp_filename.replace(filename)
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        while self._disk_bytes > self.disk_budget and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                (self.path / key).unlink()
+            except FileNotFoundError:
+                pass
+
+
+_artwork_cache = None
+_artwork_cache_lock = threading.Lock()
+
+
+def configure_artwork_cache(disk_budget: int, max_size: int = None) -> None:
+    global _artwork_cache
+    with _artwork_cache_lock:
+        _artwork_cache = ArtworkCache(get_cache_dir(), disk_budget, max_size=max_size)
+
+
+def get_artwork_cache() -> ArtworkCache:
+    global _artwork_cache
+    with _artwork_cache_lock:
+        if _artwork_cache is None:
+            _artwork_cache = ArtworkCache(get_cache_dir())
+        return _artwork_cache
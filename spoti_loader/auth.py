@@ -0,0 +1,76 @@
+import json
+import logging
+import threading
+import time
+
+# Tokens are refreshed this many seconds before they expire, so a request that
+# is already in flight does not run into the deadline.
+REFRESH_MARGIN = 300
+
+TOKEN_STATE = "web_api_token"
+
+logger = logging.getLogger(__name__)
+
+
+class TokenProvider:
+    def __init__(self, sessions, scopes: list[str], download_log=None):
+        self.scopes = scopes
+        self._sessions = sessions
+        self._download_log = download_log
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._loaded = download_log is None
+
+    def _load(self) -> None:
+        # A token saved by an earlier run is good for about an hour, reusing it
+        # saves a librespot login when the run has nothing to download.
+        self._loaded = True
+        try:
+            saved = json.loads(self._download_log.get_state(TOKEN_STATE) or "null")
+        except ValueError:
+            return
+        if saved and saved.get("scopes") == self.scopes:
+            self._token = saved["access_token"]
+            self._expires_at = float(saved["expires_at"])
+
+    def _save(self) -> None:
+        self._download_log.set_state(
+            TOKEN_STATE,
+            json.dumps(
+                {
+                    "access_token": self._token,
+                    "expires_at": self._expires_at,
+                    "scopes": self.scopes,
+                }
+            ),
+        )
+
+    def _fetch(self, session):
+        # get_token would hand back librespot's cached token until a few seconds
+        # before it expires, login5 always asks for a new one.
+        token = session.tokens().login5(self.scopes)
+        if token is None:
+            raise ValueError("Failed to fetch an access token")
+        return token
+
+    def get(self) -> str:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if self._token is None or time.time() >= self._expires_at - REFRESH_MARGIN:
+                stored = self._sessions.run(self._fetch)
+                self._token = stored.access_token
+                self._expires_at = stored.timestamp / 1000000 + stored.expires_in
+                logger.debug(f"Refreshed access token, expires in {stored.expires_in}s")
+                if self._download_log is not None:
+                    self._save()
+            return self._token
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def __str__(self) -> str:
+        return self.get()
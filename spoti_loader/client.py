@@ -0,0 +1,171 @@
+import logging
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 5
+
+READ_TIMEOUT = 30
+
+MAX_RETRIES = 5
+
+BACKOFF_BASE = 1
+
+BACKOFF_MAX = 60
+
+# A longer Retry-After is given up on rather than slept through by a worker.
+RETRY_AFTER_MAX = 120
+
+POOL_CONNECTIONS = 8
+
+POOL_MAXSIZE = 16
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The server may have acted on any other request that timed out or failed with
+# a 5xx, a retry could post a Discord message twice.
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Spotify base62 IDs and hex digests (image/lyrics paths) are collapsed so the
+# stats are grouped per endpoint rather than per resource.
+ID_SEGMENT = re.compile(r"^(?:[0-9A-Za-z]{22}|[0-9a-fA-F]{32,})$")
+
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def endpoint_name(url) -> str:
+    parts = urlsplit(url)
+    segments = [
+        "{id}" if ID_SEGMENT.match(segment) else segment
+        for segment in parts.path.split("/")
+    ]
+    return parts.netloc + "/".join(segments)
+
+
+def record_request(url, elapsed, retried=False, failed=False) -> None:
+    endpoint = endpoint_name(url)
+    with _stats_lock:
+        stats = _stats.setdefault(
+            endpoint,
+            {"count": 0, "retries": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0},
+        )
+        stats["count"] += 1
+        stats["retries"] += 1 if retried else 0
+        stats["errors"] += 1 if failed else 0
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+
+
+def get_stats() -> dict:
+    with _stats_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _stats.items()}
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+
+def format_stats() -> list[str]:
+    lines = []
+    stats = get_stats()
+    for endpoint in sorted(stats, key=lambda e: stats[e]["total_time"], reverse=True):
+        s = stats[endpoint]
+        lines.append(
+            f"{endpoint}: {s['count']} requests, {s['retries']} retries, "
+            f"{s['errors']} errors, {s['total_time']:.2f}s total, "
+            f"{s['total_time'] / s['count']:.3f}s avg, {s['max_time']:.3f}s max"
+        )
+    return lines
+
+
+def backoff_delay(attempt) -> float:
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_after_delay(response) -> float | None:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def request(method, url, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    attempt = 0
+    while True:
+        start = time.monotonic()
+        try:
+            response = get_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_request(url, time.monotonic() - start, attempt > 0, True)
+            if attempt >= MAX_RETRIES:
+                raise
+            # Read timeouts are only retried for methods that are safe to repeat.
+            if method not in IDEMPOTENT_METHODS and not isinstance(
+                e, requests.ConnectionError
+            ):
+                raise
+            delay = backoff_delay(attempt)
+            reason = str(e)
+        else:
+            record_request(url, time.monotonic() - start, attempt > 0)
+            if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                return response
+            if method not in IDEMPOTENT_METHODS and response.status_code != 429:
+                return response
+            delay = retry_after_delay(response)
+            if delay is not None and delay > RETRY_AFTER_MAX:
+                logger.warning(
+                    f"{method} {endpoint_name(url)} failed (HTTP "
+                    f"{response.status_code}), not retrying after {delay:.0f}s"
+                )
+                return response
+            if delay is None:
+                delay = backoff_delay(attempt)
+            reason = f"HTTP {response.status_code}"
+        logger.warning(
+            f"{method} {endpoint_name(url)} failed ({reason}), retrying in {delay:.1f}s"
+        )
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
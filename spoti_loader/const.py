@@ -4,6 +4,16 @@ SAVED_TRACKS_URL = "https://api.spotify.com/v1/me/tracks"
 
 TRACKS_URL = "https://api.spotify.com/v1/tracks"
 
+ARTISTS_URL = "https://api.spotify.com/v1/artists"
+
+ALBUMS_URL = "https://api.spotify.com/v1/albums"
+
+USER_PLAYLISTS_URL = "https://api.spotify.com/v1/me/playlists"
+
+PLAYLIST_URL = "https://api.spotify.com/v1/playlists/"
+
+LYRICS_URL = "https://spclient.wg.spotify.com/color-lyrics/v2/track/"
+
 TRACK_STATS_URL = "https://api.spotify.com/v1/audio-features/"
 
 TRACKNUMBER = "tracknumber"
@@ -44,6 +54,8 @@ URL = "url"
 
 RELEASE_DATE = "release_date"
 
+ADDED_AT = "added_at"
+
 IMAGES = "images"
 
 LIMIT = "limit"
@@ -72,6 +84,24 @@ PLAYLISTS = "playlists"
 
 OWNER = "owner"
 
+TOTAL = "total"
+
+NEXT = "next"
+
+CURSORS = "cursors"
+
+AFTER = "after"
+
+IDS = "ids"
+
+MARKET = "market"
+
+SNAPSHOT_ID = "snapshot_id"
+
+IS_LOCAL = "is_local"
+
+INCLUDE_GROUPS = "include_groups"
+
 DISPLAY_NAME = "display_name"
 
 ALBUMS = "albums"
@@ -92,6 +122,8 @@ USER_LIBRARY_READ = "user-library-read"
 
 WINDOWS_SYSTEM = "Windows"
 
+DEFAULT_FORMAT = "ogg"
+
 CODEC_MAP = {
     "aac": "aac",
     "fdk_aac": "libfdk_aac",
@@ -111,3 +143,13 @@ EXT_MAP = {
     "opus": "ogg",
     "vorbis": "ogg",
 }
+
+MUXER_MAP = {
+    "aac": "ipod",
+    "fdk_aac": "ipod",
+    "m4a": "ipod",
+    "mp3": "mp3",
+    "ogg": "ogg",
+    "opus": "ogg",
+    "vorbis": "ogg",
+}
@@ -1,16 +1,36 @@
-from .utils import invoke_url, fix_filename, get_log_db
+from .utils import fix_filename
+from .metadata import TrackInfo, TrackUnavailable, get_song_info
+from .template import get_output_template
+from .postprocess import get_postprocessor
+from .store import get_download_log
+from .artwork import get_artwork_cache
+from .fsindex import get_output_index
+from .artists import get_artist_cache
+from .lyrics import get_lyrics_fetcher, get_lyrics_filename, remove_lyrics
+from . import metrics
 from .const import *
 from pathlib import PurePath, Path
+from contextlib import nullcontext
+import logging
 import os
-import re
-import sqlite3
-import math
-import ffmpy
-import music_tag
-import requests
+import shutil
+import time
 import json
-from librespot.metadata import TrackId
-from librespot.audio.decoders import VorbisOnlyAudioQuality, AudioQuality
+
+
+OGG_CAPTURE_PATTERN = b"OggS"
+
+VORBIS_IDENTIFICATION = b"\x01vorbis"
+
+OGG_PROBE_SIZE = 4096
+
+STREAM_CHUNK_SIZE = 128 * 1024
+
+PROGRESS_INTERVAL = 1024 * 1024
+
+PART_SUFFIX = ".part"
+
+logger = logging.getLogger(__name__)
 
 
 def conv_artist_format(artists) -> str:
@@ -18,8 +38,20 @@ def conv_artist_format(artists) -> str:
 
 
 def set_audio_tags(
-    filename, artists, genres, name, album_name, release_year, disc_number, track_number
+    filename,
+    artists,
+    genres,
+    name,
+    album_name,
+    release_year,
+    disc_number,
+    track_number,
+    artwork: bytes = None,
 ) -> None:
+    import music_tag
+
+    # Text tags and artwork go into a single load/save so the file is only
+    # parsed and rewritten once.
     tags = music_tag.load_file(filename)
     tags[ALBUMARTIST] = artists[0]
     tags[ARTIST] = conv_artist_format(artists)
@@ -29,152 +61,144 @@ def set_audio_tags(
     tags[YEAR] = release_year
     tags[DISCNUMBER] = disc_number
     tags[TRACKNUMBER] = track_number
+    if artwork is not None:
+        tags[ARTWORK] = artwork
     tags.save()
 
 
-def set_music_thumbnail(filename, image_url) -> None:
-    img = requests.get(image_url).content
-    tags = music_tag.load_file(filename)
-    tags[ARTWORK] = img
-    tags.save()
+def get_music_thumbnail(image_url) -> bytes:
+    with metrics.timed("artwork"):
+        return get_artwork_cache().get(image_url)
 
 
-def get_song_genres(token, rawartists: list[str], track_name: str) -> list[str]:
+def get_song_genres(token, rawartists: list[dict], track_name: str) -> list[str]:
     try:
-        genres = []
-        for data in rawartists:
-            (raw, artistInfo) = invoke_url(token, f"{data[HREF]}")
-            if len(artistInfo[GENRES]) > 0:
-                for genre in artistInfo[GENRES]:
-                    genres.append(genre)
-            elif len(artistInfo[GENRES]) > 0:
-                genres.append(artistInfo[GENRES][0])
+        with metrics.timed("genres"):
+            genres = get_artist_cache().get_genres(
+                token, [data[ID] for data in rawartists if data.get(ID)]
+            )
         if len(genres) == 0:
             genres.append("")
         return genres
     except Exception as e:
-        raise ValueError(f"Failed to parse GENRES response: {str(e)}\n{raw}")
+        raise ValueError(f"Failed to fetch genres for {track_name}: {str(e)}")
 
 
 def create_download_directory(download_path: str) -> None:
     Path(os.path.expanduser(download_path)).mkdir(parents=True, exist_ok=True)
 
 
-def get_content_stream(session, content_id):
-    return session.content_feeder().load(
-        content_id, VorbisOnlyAudioQuality(AudioQuality.HIGH), False, None
-    )
-
+def get_content_stream(sessions, content_id):
+    from librespot.audio.decoders import VorbisOnlyAudioQuality, AudioQuality
 
-def get_song_lyrics(token, song_id: str, file_save: str) -> None:
-    raw, lyrics = invoke_url(
-        token, f"https://spclient.wg.spotify.com/color-lyrics/v2/track/{song_id}"
-    )
-    if lyrics:
-        try:
-            formatted_lyrics = lyrics["lyrics"]["lines"]
-        except KeyError:
-            raise ValueError(f"Failed to fetch lyrics: {song_id}")
-        if lyrics["lyrics"]["syncType"] == "UNSYNCED":
-            with open(file_save, "w+", encoding="utf-8") as file:
-                for line in formatted_lyrics:
-                    file.writelines(line["words"] + "\n")
-            return
-        elif lyrics["lyrics"]["syncType"] == "LINE_SYNCED":
-            with open(file_save, "w+", encoding="utf-8") as file:
-                for line in formatted_lyrics:
-                    timestamp = int(line["startTimeMs"])
-                    ts_minutes = str(math.floor(timestamp / 60000)).zfill(2)
-                    ts_seconds = str(math.floor((timestamp % 60000) / 1000)).zfill(2)
-                    ts_millis = str(math.floor(timestamp % 1000))[:2].zfill(2)
-                    file.writelines(
-                        f"[{ts_minutes}:{ts_seconds}.{ts_millis}]"
-                        + line["words"]
-                        + "\n"
-                    )
-            return
-    raise ValueError(f"Failed to fetch lyrics: {song_id}")
-
-
-def add_to_already_downloaded(song_id, filename) -> None:
-    conn = sqlite3.connect(get_log_db())
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO songs (id, filename) VALUES (?, ?)", (song_id, filename)
-    )
-    conn.commit()
-    conn.close()
-
-
-def remove_song_from_log(song_id):
-    conn = sqlite3.connect(get_log_db())
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM songs where id = ?", (song_id,))
-    conn.commit()
-    conn.close()
-
-
-def song_previously_downloaded(song_id: str) -> bool:
-    conn = sqlite3.connect(get_log_db())
-    cursor = conn.cursor()
-    cursor.execute("SELECT EXISTS (SELECT 1 FROM songs WHERE id = ?);", (song_id,))
-    result = cursor.fetchone()
-
-    # Close the database connection
-    conn.close()
-
-    # Return True if the song_id exists, False otherwise
-    return result[0] == 1
+    # The session is only held while the stream is set up (storage resolve and
+    # audio key), the chunks themselves come from the CDN over HTTPS.
+    with metrics.timed("stream_setup"):
+        return sessions.run(
+            lambda session: session.content_feeder().load(
+                content_id, VorbisOnlyAudioQuality(AudioQuality.HIGH), False, None
+            )
+        )
 
 
-def get_song_info(
-    token,
-    song_id,
-):
-    (raw, info) = invoke_url(token, f"{TRACKS_URL}?ids={song_id}&market=from_token")
-    if not TRACKS in info:
-        raise ValueError(f"Invalid response from TRACKS_URL:\n{raw}")
+def preallocate(file, size: int) -> None:
+    if not hasattr(os, "posix_fallocate") or size <= 0:
+        return
     try:
-        track = info[TRACKS][0]
-        artists = []
-        for data in info[TRACKS][0][ARTISTS]:
-            artists.append(data[NAME])
-
-        album_name = info[TRACKS][0][ALBUM][NAME]
-        name = info[TRACKS][0][NAME]
-        release_year = info[TRACKS][0][ALBUM][RELEASE_DATE].split("-")[0]
-        disc_number = info[TRACKS][0][DISC_NUMBER]
-        track_number = info[TRACKS][0][TRACK_NUMBER]
-        scraped_song_id = info[TRACKS][0][ID]
-        is_playable = info[TRACKS][0][IS_PLAYABLE]
-        duration_ms = info[TRACKS][0][DURATION_MS]
-
-        image = info[TRACKS][0][ALBUM][IMAGES][0]
-        for i in info[TRACKS][0][ALBUM][IMAGES]:
-            if i[WIDTH] > image[WIDTH]:
-                image = i
-        image_url = image[URL]
-
-        return (
-            artists,
-            info[TRACKS][0][ARTISTS],
-            album_name,
-            name,
-            image_url,
-            release_year,
-            disc_number,
-            track_number,
-            scraped_song_id,
-            is_playable,
-            duration_ms,
-        )
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError:
+        # Not every filesystem supports it, the writes below still work.
+        pass
+
+
+def transfer_stream(
+    input_stream, filename, resume_from: int = 0, on_progress=None
+) -> tuple[int, float]:
+    # librespot decrypts the file in 128 KiB chunks and its read() stops at a
+    # chunk boundary, so each read asks for exactly the rest of one chunk.
+    source = input_stream.stream()
+    start_pos = source.pos()
+    total = input_stream.size - start_pos
+    written = resume_from
+    reported = resume_from
+    start = time.monotonic()
+    if resume_from:
+        source.seek(start_pos + resume_from)
+    with open(filename, "r+b" if resume_from else "wb") as file:
+        file.truncate(resume_from)
+        preallocate(file, total)
+        file.seek(resume_from)
+        while written < total:
+            pos = start_pos + written
+            size = min(total - written, STREAM_CHUNK_SIZE - pos % STREAM_CHUNK_SIZE)
+            data = source.read(size)
+            if not data:
+                raise IOError(f"Stream ended after {written} of {total} bytes")
+            file.write(data)
+            written += len(data)
+            if on_progress is not None and written - reported >= PROGRESS_INTERVAL:
+                file.flush()
+                on_progress(written)
+                reported = written
+    return written - resume_from, time.monotonic() - start
+
+
+def get_resume_offset(download_log, song_id: str, filename, size: int) -> int:
+    partial = download_log.get_partial(song_id)
+    if partial is None:
+        return 0
+    part_filename, offset, part_size = partial
+    # Only continue a partial download of the very same file into the same
+    # place, anything else is stale and starts over.
+    if (
+        part_filename == str(filename)
+        and part_size == size
+        and Path(filename).exists()
+        and Path(filename).stat().st_size >= offset
+    ):
+        return offset
+    if Path(part_filename).exists():
+        Path(part_filename).unlink()
+    download_log.remove_partial(song_id)
+    return 0
+
+
+def postprocess_track(filename, download_format: str, tags: tuple) -> dict:
+    """Converts and tags a transferred track, in a post-processing worker.
+
+    Returns the time spent in each stage, metrics recorded here would stay in
+    the worker process.
+    """
+    start = time.perf_counter()
+    try:
+        convert_audio_format(filename, download_format)
     except Exception as e:
-        raise ValueError(f"Failed to parse TRACKS_URL response: {str(e)}\n{raw}")
+        # Only plain exceptions are sure to make it back from the worker.
+        raise ValueError(f"Unable to convert to {download_format}: {e}")
+    converted = time.perf_counter()
+    try:
+        set_audio_tags(filename, *tags)
+    except Exception:
+        raise ValueError(
+            "Unable to write metadata, ensure ffmpeg is installed and added to your PATH."
+        )
+    return {"convert": converted - start, "tag": time.perf_counter() - converted}
 
 
-def download_track(session, token: str, downloadPath: str, track_id: str) -> None:
+def download_track(
+    sessions,
+    token: str,
+    downloadPath: str,
+    track_id: str,
+    info: TrackInfo = None,
+    transfers=None,
+) -> None:
+    from librespot.metadata import TrackId
+
     try:
-        output_template = "{artist} - {song_name}.{ext}"
+        if info is None:
+            with metrics.timed("metadata"):
+                info = get_song_info(token, track_id)
         (
             artists,
             raw_artists,
@@ -187,57 +211,40 @@ def download_track(session, token: str, downloadPath: str, track_id: str) -> Non
             scraped_song_id,
             is_playable,
             duration_ms,
-        ) = get_song_info(token, track_id)
+        ) = info
         song_name = fix_filename(artists[0]) + " - " + fix_filename(name)
-        ext = EXT_MAP.get("ogg")
-
-        output_template = output_template.replace("{artist}", fix_filename(artists[0]))
-        output_template = output_template.replace("{album}", fix_filename(album_name))
-        output_template = output_template.replace("{song_name}", fix_filename(name))
-        output_template = output_template.replace(
-            "{release_year}", fix_filename(release_year)
-        )
-        output_template = output_template.replace(
-            "{disc_number}", fix_filename(disc_number)
-        )
-        output_template = output_template.replace(
-            "{track_number}", fix_filename(track_number)
+        filename = PurePath(downloadPath).joinpath(
+            get_output_template().render_info(info, track_id)
         )
-        output_template = output_template.replace("{id}", fix_filename(scraped_song_id))
-        output_template = output_template.replace("{track_id}", fix_filename(track_id))
-        output_template = output_template.replace("{ext}", ext)
-
-        filename = PurePath(downloadPath).joinpath(output_template)
         filedir = PurePath(filename).parent
 
-        filename_temp = filename
-        check_name = Path(filename).is_file() and Path(filename).stat().st_size
-        check_id = song_previously_downloaded(scraped_song_id)
-        if check_id and not check_name:
-            remove_song_from_log(scraped_song_id)
-        if not check_id and check_name:
-            c = (
-                len(
-                    [
-                        file
-                        for file in Path(filedir).iterdir()
-                        if re.search(f"^{filename}_", str(file))
-                    ]
-                )
-                + 1
-            )
-            fname = PurePath(PurePath(filename).name).parent
-            ext = PurePath(PurePath(filename).name).suffix
-
-            filename = PurePath(filedir).joinpath(f"{fname}_{c}{ext}")
-        if check_id and check_name:
-            return None
+        download_log = get_download_log()
+        output_index = get_output_index(downloadPath)
+        check_id = scraped_song_id in download_log
+        # Two workers may resolve to the same name, so the existence check and
+        # the reservation of the output file have to happen atomically.
+        with output_index.lock:
+            check_name = output_index.has_file(filename)
+            if check_id and check_name:
+                return None
+            if check_id and not check_name:
+                download_log.remove(scraped_song_id)
+            filename = output_index.reserve(filename)
+        filename_temp = PurePath(f"{filename}{PART_SUFFIX}")
+    except TrackUnavailable as e:
+        # Skipped rather than failed, it would otherwise hold the sync cursor
+        # back on every run.
+        logger.warning(f"Skipping {track_id}: {e}")
+        return None
     except Exception as e:
         raise ValueError(f"Failed to query metadata : Track_ID{str(track_id)}")
     else:
+        lyrics_future = None
         try:
             if not is_playable:
-                raise ValueError(f"Song is not playable: {song_name}")
+                # Region locked or withdrawn, skipped like an unavailable track.
+                logger.warning(f"Skipping {song_name}: song is not playable")
+                return None
             else:
                 if check_id and check_name:
                     raise ValueError(f"Song is already downloaded: {song_name}")
@@ -245,63 +252,141 @@ def download_track(session, token: str, downloadPath: str, track_id: str) -> Non
                     if track_id != scraped_song_id:
                         track_id = scraped_song_id
                     track = TrackId.from_base62(track_id)
-                    stream = get_content_stream(session, track)
                     create_download_directory(filedir)
-                    total_size = stream.input_stream.size
-                    downloaded = 0
-                    with open(filename_temp, "wb") as file:
-                        b = 0
-                        while b < 5:
-                            data = stream.input_stream.stream().read(20000)
-                            file.write(data)
-                            downloaded += len(data)
-                            b += 1 if data == b"" else 0
-                    try:
-                        get_song_lyrics(
-                            token, track_id, PurePath(str(filename)[:-3] + "lrc")
+                    # Lyrics are fetched on their own pool while the audio streams.
+                    lyrics_fetcher = get_lyrics_fetcher()
+                    if lyrics_fetcher.should_fetch(track_id):
+                        lyrics_future = lyrics_fetcher.submit(
+                            token, track_id, get_lyrics_filename(filename), output_index
+                        )
+                    # Only the streaming holds one of the transfer slots, the thread
+                    # then waits for post-processing without one.
+                    with transfers or nullcontext():
+                        stream = get_content_stream(sessions, track)
+                        size = stream.input_stream.size
+                        resume_from = get_resume_offset(
+                            download_log, track_id, filename_temp, size
                         )
+                        if resume_from:
+                            logger.info(f"Resuming {song_name} at {resume_from} bytes")
+                        downloaded, elapsed = transfer_stream(
+                            stream.input_stream,
+                            filename_temp,
+                            resume_from,
+                            lambda offset: download_log.set_partial(
+                                track_id, str(filename_temp), offset, size
+                            ),
+                        )
+                        metrics.record("transfer", elapsed)
+                        metrics.add("bytes_transferred", downloaded)
+                        # Only the transfer is resumable, a failure after this point
+                        # starts the track over.
+                        download_log.remove_partial(track_id)
+                    rate = downloaded / max(elapsed, 1e-6) / 1024
+                    logger.info(
+                        f"Transferred {song_name}: {downloaded} bytes in "
+                        f"{elapsed:.2f}s ({rate:.0f} KiB/s)"
+                    )
+                    try:
+                        genres = get_song_genres(token, raw_artists, name)
                     except ValueError:
-                        pass
-                    """ try: """
-                    """     genres = get_song_genres(raw_artists, name) """
-                    """ except Exception: """
-                    """     genres = [""] """
-                    convert_audio_format(filename_temp)
+                        genres = [""]
                     try:
-                        set_audio_tags(
-                            filename_temp,
+                        artwork = get_music_thumbnail(image_url)
+                    except Exception as e:
+                        # A missing cover is no reason to throw the audio away.
+                        logger.warning(f"Failed to fetch artwork for {song_name}: {e}")
+                        artwork = None
+                    postprocessor = get_postprocessor()
+                    stages = postprocessor.run(
+                        postprocess_track,
+                        str(filename_temp),
+                        postprocessor.download_format,
+                        (
                             artists,
-                            [""],
+                            genres,
                             name,
                             album_name,
                             release_year,
                             disc_number,
                             track_number,
-                        )
-                        set_music_thumbnail(filename_temp, image_url)
-                    except Exception:
-                        raise ValueError(
-                            "Unable to write metadata, ensure ffmpeg is installed and added to your PATH."
-                        )
-                    if filename_temp != filename:
-                        Path(filename_temp).rename(filename)
-                    add_to_already_downloaded(scraped_song_id, PurePath(filename).name)
+                            artwork,
+                        ),
+                    )
+                    for stage, seconds in stages.items():
+                        metrics.record(stage, seconds)
+                    Path(filename_temp).replace(filename)
+                    output_index.add(filename)
+                    # Stored relative to the output directory, which a template
+                    # with directories needs to find the file again.
+                    download_log.add(
+                        scraped_song_id,
+                        str(PurePath(filename).relative_to(downloadPath)),
+                    )
+                    metrics.add("tracks_downloaded")
                     return song_name
         except Exception as e:
-            if Path(filename_temp).exists():
+            # A partial transfer recorded in the log is kept for the next run.
+            resumable = download_log.get_partial(scraped_song_id) is not None
+            if not resumable and Path(filename_temp).exists():
                 Path(filename_temp).unlink()
+            if lyrics_future is not None and not lyrics_future.cancel():
+                # The fetch may be sleeping in a retry backoff, it removes its
+                # own file once it is done instead of holding this worker.
+                lyrics_future.add_done_callback(
+                    lambda _: remove_lyrics(filename, output_index)
+                )
+            # The caller has to see the failure, or the sync cursor would move
+            # past a track that was never downloaded.
+            raise ValueError(f"Failed to download {song_name}: {e}") from e
+        finally:
+            output_index.release(filename)
+
+
+def find_ogg_vorbis_start(filename) -> int | None:
+    with open(filename, "rb") as file:
+        head = file.read(OGG_PROBE_SIZE)
+    start = head.find(OGG_CAPTURE_PATTERN)
+    # The first page of an Ogg Vorbis stream holds only the identification
+    # header, right after the 27 byte page header and the segment table.
+    if start < 0 or len(head) < start + 27:
+        return None
+    packet = start + 27 + head[start + 26]
+    if head[packet : packet + len(VORBIS_IDENTIFICATION)] != VORBIS_IDENTIFICATION:
+        return None
+    return start
+
+
+def strip_leading_bytes(filename, count: int) -> None:
+    temp_filename = f"{filename}.tmp"
+    with open(filename, "rb") as src, open(temp_filename, "wb") as dst:
+        src.seek(count)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    Path(temp_filename).replace(filename)
+
+
+def convert_audio_format(filename, download_format: str = DEFAULT_FORMAT) -> None:
+    file_codec = CODEC_MAP.get(download_format, "copy")
+    if file_codec == "copy":
+        # librespot already skips Spotify's header, so the stream is normally a
+        # valid Ogg Vorbis file and remuxing it through ffmpeg is wasted work.
+        start = find_ogg_vorbis_start(filename)
+        if start == 0:
+            return
+        if start is not None:
+            strip_leading_bytes(filename, start)
+            return
+    import ffmpy
 
-
-def convert_audio_format(filename) -> None:
-    temp_filename = f"{PurePath(filename).parent}.tmp"
+    temp_filename = f"{filename}.tmp"
     Path(filename).replace(temp_filename)
-    download_format = "ogg"
-    file_codec = CODEC_MAP.get(download_format, "copy")
     if file_codec != "copy":
         bitrate = "160k"
     else:
         bitrate = None
-    output_params = ["-c:a", file_codec]
+    # The container is named explicitly since the .part suffix says nothing
+    # about the format.
+    output_params = ["-c:a", file_codec, "-f", MUXER_MAP.get(download_format, "ogg")]
     if bitrate:
         output_params += ["-b:a", bitrate]
     ff_m = ffmpy.FFmpeg(
@@ -0,0 +1,141 @@
+import os
+import threading
+from pathlib import PurePath
+from .store import get_download_log
+
+
+class OutputIndex:
+    def __init__(self, root: str, download_log=None):
+        self.root = os.path.abspath(root)
+        self.lock = threading.RLock()
+        self._download_log = download_log
+        self._directories = {}
+        self._files = {}
+        self._claimed = set()
+        self._dirty = set()
+        known_directories, known_files = ({}, {})
+        if download_log is not None:
+            known_directories, known_files = download_log.load_file_index()
+        self._scan(self.root, known_directories, known_files)
+
+    def _scan(self, directory: str, known_directories: dict, known_files: dict):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except FileNotFoundError:
+            return
+        # A directory whose mtime did not change since it was persisted has the
+        # same entries, so its files and subdirectories are taken from the log.
+        if mtime == known_directories.get(directory):
+            self._directories[directory] = mtime
+            self._files[directory] = dict(known_files.get(directory, {}))
+            for name, (size, _) in self._files[directory].items():
+                if size is None:
+                    self._scan(
+                        os.path.join(directory, name), known_directories, known_files
+                    )
+            return
+        self._directories[directory] = mtime
+        self._files[directory] = {}
+        self._dirty.add(directory)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self._files[directory][entry.name] = (None, None)
+                    self._scan(entry.path, known_directories, known_files)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    self._files[directory][entry.name] = (stat.st_size, stat.st_mtime)
+
+    def _entry(self, filename) -> tuple | None:
+        path = PurePath(os.path.abspath(filename))
+        return self._files.get(str(path.parent), {}).get(path.name)
+
+    def has_file(self, filename) -> bool:
+        with self.lock:
+            entry = self._entry(filename)
+            return entry is not None and bool(entry[0])
+
+    def exists(self, filename) -> bool:
+        with self.lock:
+            return self._entry(filename) is not None
+
+    def reserve(self, filename) -> PurePath:
+        with self.lock:
+            if self.has_file(filename) or str(filename) in self._claimed:
+                filedir = PurePath(filename).parent
+                fname = PurePath(filename).stem
+                ext = PurePath(filename).suffix
+                c = 1
+                while True:
+                    candidate = PurePath(filedir).joinpath(f"{fname}_{c}{ext}")
+                    claimed = str(candidate) in self._claimed
+                    if not claimed and not self.exists(candidate):
+                        break
+                    c += 1
+                filename = candidate
+            self._claimed.add(str(filename))
+            return PurePath(filename)
+
+    def release(self, filename) -> None:
+        with self.lock:
+            self._claimed.discard(str(filename))
+
+    def add(self, filename) -> None:
+        stat = os.stat(filename)
+        path = PurePath(os.path.abspath(filename))
+        with self.lock:
+            self._add_directory(str(path.parent))
+            self._files[str(path.parent)][path.name] = (stat.st_size, stat.st_mtime)
+            self._dirty.add(str(path.parent))
+
+    def _add_directory(self, directory: str) -> None:
+        if directory in self._files:
+            return
+        self._files[directory] = {}
+        self._directories[directory] = None
+        parent = os.path.dirname(directory)
+        if directory != self.root and parent != directory:
+            self._add_directory(parent)
+            self._files[parent][os.path.basename(directory)] = (None, None)
+            self._dirty.add(parent)
+
+    def remove(self, filename) -> None:
+        path = PurePath(os.path.abspath(filename))
+        with self.lock:
+            if self._files.get(str(path.parent), {}).pop(path.name, None):
+                self._dirty.add(str(path.parent))
+
+    def save(self) -> None:
+        if self._download_log is None:
+            return
+        with self.lock:
+            # Directories we wrote to keep their scan time mtime (or none), so
+            # they are rescanned on the next run rather than trusted blindly.
+            self._download_log.save_file_index(
+                {
+                    directory: (self._directories.get(directory), files)
+                    for directory, files in self._files.items()
+                    if directory in self._dirty
+                }
+            )
+            self._dirty = set()
+
+
+_output_indexes = {}
+_output_indexes_lock = threading.Lock()
+
+
+def get_output_index(root: str, persist: bool = False) -> OutputIndex:
+    root = os.path.abspath(root)
+    with _output_indexes_lock:
+        if root not in _output_indexes:
+            download_log = get_download_log() if persist else None
+            _output_indexes[root] = OutputIndex(root, download_log)
+        return _output_indexes[root]
+
+
+def close_output_indexes() -> None:
+    with _output_indexes_lock:
+        for output_index in _output_indexes.values():
+            output_index.save()
+        _output_indexes.clear()
@@ -0,0 +1,132 @@
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePath
+from .utils import get_with_token
+from .store import get_download_log
+from .const import LYRICS_URL
+from . import metrics
+
+DEFAULT_RETRY_DAYS = 30
+
+DEFAULT_WORKERS = 2
+
+logger = logging.getLogger(__name__)
+
+
+class LyricsUnavailable(ValueError):
+    pass
+
+
+def get_lyrics_filename(filename) -> PurePath:
+    return PurePath(filename).with_suffix(".lrc")
+
+
+def remove_lyrics(filename, output_index=None) -> None:
+    lyrics_filename = get_lyrics_filename(filename)
+    Path(lyrics_filename).unlink(missing_ok=True)
+    if output_index is not None:
+        output_index.remove(lyrics_filename)
+
+
+def get_song_lyrics(token, song_id: str, file_save: str) -> None:
+    response = get_with_token(token, f"{LYRICS_URL}{song_id}")
+    if response.status_code == 404:
+        raise LyricsUnavailable(f"No lyrics available: {song_id}")
+    try:
+        lyrics = response.json()
+    except Exception:
+        raise ValueError(f"Failed to fetch lyrics: {song_id}")
+    if lyrics:
+        try:
+            formatted_lyrics = lyrics["lyrics"]["lines"]
+        except KeyError:
+            raise ValueError(f"Failed to fetch lyrics: {song_id}")
+        if lyrics["lyrics"]["syncType"] == "UNSYNCED":
+            with open(file_save, "w+", encoding="utf-8") as file:
+                for line in formatted_lyrics:
+                    file.writelines(line["words"] + "\n")
+            return
+        elif lyrics["lyrics"]["syncType"] == "LINE_SYNCED":
+            with open(file_save, "w+", encoding="utf-8") as file:
+                for line in formatted_lyrics:
+                    timestamp = int(line["startTimeMs"])
+                    ts_minutes = str(math.floor(timestamp / 60000)).zfill(2)
+                    ts_seconds = str(math.floor((timestamp % 60000) / 1000)).zfill(2)
+                    ts_millis = str(math.floor(timestamp % 1000))[:2].zfill(2)
+                    file.writelines(
+                        f"[{ts_minutes}:{ts_seconds}.{ts_millis}]"
+                        + line["words"]
+                        + "\n"
+                    )
+            return
+    raise ValueError(f"Failed to fetch lyrics: {song_id}")
+
+
+class LyricsFetcher:
+    def __init__(
+        self,
+        download_log,
+        workers: int = DEFAULT_WORKERS,
+        retry_days: float = DEFAULT_RETRY_DAYS,
+    ):
+        self.retry_days = retry_days
+        self._download_log = download_log
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="lyrics"
+        )
+
+    def should_fetch(self, song_id: str) -> bool:
+        retry_after = self._download_log.get_lyrics_retry_after(song_id)
+        return retry_after is None or retry_after <= time.time()
+
+    def fetch(self, token, song_id: str, filename, output_index=None) -> bool:
+        try:
+            with metrics.timed("lyrics"):
+                get_song_lyrics(token, song_id, filename)
+        except LyricsUnavailable:
+            # Remembered so the endpoint is not asked again every single run.
+            retry_after = time.time() + self.retry_days * 86400
+            self._download_log.set_lyrics_retry_after(song_id, retry_after)
+            return False
+        except Exception as e:
+            logger.debug(f"Failed to fetch lyrics for {song_id}: {e}")
+            return False
+        self._download_log.set_lyrics_retry_after(song_id, None)
+        if output_index is not None:
+            output_index.add(filename)
+        return True
+
+    def submit(self, token, song_id: str, filename, output_index=None) -> Future:
+        return self._executor.submit(self.fetch, token, song_id, filename, output_index)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+_lyrics_fetcher = None
+_lyrics_fetcher_lock = threading.Lock()
+
+
+def configure_lyrics_fetcher(workers: int, retry_days: float) -> None:
+    global _lyrics_fetcher
+    with _lyrics_fetcher_lock:
+        _lyrics_fetcher = LyricsFetcher(get_download_log(), workers, retry_days)
+
+
+def get_lyrics_fetcher() -> LyricsFetcher:
+    global _lyrics_fetcher
+    with _lyrics_fetcher_lock:
+        if _lyrics_fetcher is None:
+            _lyrics_fetcher = LyricsFetcher(get_download_log())
+        return _lyrics_fetcher
+
+
+def close_lyrics_fetcher() -> None:
+    global _lyrics_fetcher
+    with _lyrics_fetcher_lock:
+        if _lyrics_fetcher is not None:
+            _lyrics_fetcher.close()
+            _lyrics_fetcher = None
@@ -0,0 +1,111 @@
+from typing import NamedTuple
+from .utils import invoke_url
+from .const import *
+
+# The Tracks endpoint accepts at most 50 comma separated IDs per request.
+TRACKS_BATCH_SIZE = 50
+
+
+class TrackUnavailable(ValueError):
+    pass
+
+
+class TrackInfo(NamedTuple):
+    artists: list[str]
+    raw_artists: list[dict]
+    album_name: str
+    name: str
+    image_url: str
+    release_year: str
+    disc_number: int
+    track_number: int
+    scraped_song_id: str
+    is_playable: bool
+    duration_ms: int
+
+
+def is_complete_track(track) -> bool:
+    try:
+        return (
+            bool(track[ID])
+            and bool(track[NAME])
+            and len(track[ARTISTS]) > 0
+            and bool(track[ALBUM][NAME])
+            and bool(track[ALBUM][RELEASE_DATE])
+            and len(track[ALBUM][IMAGES]) > 0
+            and IS_PLAYABLE in track
+            and DISC_NUMBER in track
+            and TRACK_NUMBER in track
+            and DURATION_MS in track
+        )
+    except (KeyError, TypeError):
+        return False
+
+
+def parse_track(track) -> TrackInfo:
+    artists = []
+    for data in track[ARTISTS]:
+        artists.append(data[NAME])
+
+    image = track[ALBUM][IMAGES][0]
+    for i in track[ALBUM][IMAGES]:
+        if i[WIDTH] > image[WIDTH]:
+            image = i
+
+    return TrackInfo(
+        artists=artists,
+        raw_artists=track[ARTISTS],
+        album_name=track[ALBUM][NAME],
+        name=track[NAME],
+        image_url=image[URL],
+        release_year=track[ALBUM][RELEASE_DATE].split("-")[0],
+        disc_number=track[DISC_NUMBER],
+        track_number=track[TRACK_NUMBER],
+        scraped_song_id=track[ID],
+        is_playable=track[IS_PLAYABLE],
+        duration_ms=track[DURATION_MS],
+    )
+
+
+def get_tracks_info(token, track_ids: list[str]) -> dict[str, TrackInfo]:
+    tracks = {}
+    for i in range(0, len(track_ids), TRACKS_BATCH_SIZE):
+        batch = track_ids[i : i + TRACKS_BATCH_SIZE]
+        raw, info = invoke_url(
+            token, f"{TRACKS_URL}?ids={','.join(batch)}&market=from_token"
+        )
+        if not TRACKS in info:
+            raise ValueError(f"Invalid response from TRACKS_URL:\n{raw}")
+        # Results come back in request order, with null for unknown IDs. The
+        # returned ID may differ from the requested one when a track is relinked.
+        for track_id, track in zip(batch, info[TRACKS]):
+            if track is None:
+                continue
+            try:
+                tracks[track_id] = parse_track(track)
+            except Exception as e:
+                raise ValueError(
+                    f"Failed to parse TRACKS_URL response: {str(e)}\n{raw}"
+                )
+    return tracks
+
+
+def resolve_tracks(token, tracks: list[dict]) -> dict[str, TrackInfo]:
+    resolved = {}
+    missing = []
+    for track in tracks:
+        if is_complete_track(track):
+            resolved[track[ID]] = parse_track(track)
+        elif track.get(ID):
+            missing.append(track[ID])
+    resolved.update(get_tracks_info(token, list(dict.fromkeys(missing))))
+    return resolved
+
+
+def get_song_info(token, song_id) -> TrackInfo:
+    tracks = get_tracks_info(token, [song_id])
+    if song_id not in tracks:
+        # A valid response with null in place of the track, asking again
+        # will not change that.
+        raise TrackUnavailable(f"Track is not available: {song_id}")
+    return tracks[song_id]
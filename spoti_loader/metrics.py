@@ -0,0 +1,110 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from .utils import write_atomic
+
+PROMETHEUS_PREFIX = "spotiloader"
+
+_samples = {}
+_counters = {}
+_metrics_lock = threading.Lock()
+
+
+def record(stage: str, seconds: float) -> None:
+    with _metrics_lock:
+        _samples.setdefault(stage, []).append(seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def add(counter: str, value: float = 1) -> None:
+    with _metrics_lock:
+        _counters[counter] = _counters.get(counter, 0) + value
+
+
+def reset() -> None:
+    with _metrics_lock:
+        _samples.clear()
+        _counters.clear()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    # Nearest rank on the sorted samples, good enough for a few thousand tracks.
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+def get_report() -> dict:
+    with _metrics_lock:
+        samples = {stage: sorted(values) for stage, values in _samples.items()}
+        counters = dict(_counters)
+    return {
+        "stages": {
+            stage: {
+                "count": len(values),
+                "total": sum(values),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "max": values[-1],
+            }
+            for stage, values in samples.items()
+        },
+        "counters": counters,
+    }
+
+
+def format_report(report: dict = None) -> list[str]:
+    report = get_report() if report is None else report
+    stages = report["stages"]
+    lines = []
+    for stage in sorted(stages, key=lambda s: stages[s]["total"], reverse=True):
+        s = stages[stage]
+        lines.append(
+            f"{stage}: {s['count']}x, {s['total']:.2f}s total, "
+            f"{s['p50']:.3f}s p50, {s['p95']:.3f}s p95, {s['max']:.3f}s max"
+        )
+    for counter, value in sorted(report["counters"].items()):
+        lines.append(f"{counter}: {value:g}")
+    return lines
+
+
+def write_json(path: str, report: dict = None) -> None:
+    report = get_report() if report is None else report
+    write_atomic(path, json.dumps({"timestamp": time.time(), **report}, indent=2))
+
+
+def format_prometheus(report: dict = None) -> str:
+    report = get_report() if report is None else report
+    name = f"{PROMETHEUS_PREFIX}_stage_seconds"
+    lines = [
+        f"# HELP {name} Time spent in each stage during the last run.",
+        f"# TYPE {name} summary",
+    ]
+    for stage, s in sorted(report["stages"].items()):
+        lines.append(f'{name}{{stage="{stage}",quantile="0.5"}} {s["p50"]}')
+        lines.append(f'{name}{{stage="{stage}",quantile="0.95"}} {s["p95"]}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {s["total"]}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {s["count"]}')
+    lines.append(f"# HELP {name}_max Slowest sample of each stage during the last run.")
+    lines.append(f"# TYPE {name}_max gauge")
+    for stage, s in sorted(report["stages"].items()):
+        lines.append(f'{name}_max{{stage="{stage}"}} {s["max"]}')
+    for counter, value in sorted(report["counters"].items()):
+        counter_name = f"{PROMETHEUS_PREFIX}_{counter}"
+        lines.append(f"# TYPE {counter_name} gauge")
+        lines.append(f"{counter_name} {value}")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_last_run_timestamp_seconds gauge")
+    lines.append(f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds {time.time()}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str, report: dict = None) -> None:
+    write_atomic(path, format_prometheus(report))
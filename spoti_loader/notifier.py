@@ -0,0 +1,253 @@
+import json
+import logging
+import queue
+import threading
+import time
+import requests
+from . import client
+from .store import get_download_log
+
+# Discord rejects embeds and messages above these sizes.
+DESCRIPTION_LIMIT = 4096
+
+EMBEDS_LIMIT = 10
+
+MESSAGE_LIMIT = 6000
+
+# Longer lines, usually errors carrying a raw response, are cut short.
+LINE_LIMIT = 1000
+
+# Events are gathered this many seconds so a busy sync posts a few full
+# messages rather than one per track.
+BATCH_INTERVAL = 10
+
+# Messages that failed are tried again after this many seconds.
+RETRY_INTERVAL = 60
+
+CLOSE_TIMEOUT = 30
+
+SUCCESS_COLOR = 2605644
+
+ERROR_COLOR = 16753920
+
+REPORT_COLOR = 5793266
+
+DOWNLOADED = "downloaded"
+
+ERROR = "error"
+
+REPORT = "report"
+
+_CLOSE = object()
+
+logger = logging.getLogger(__name__)
+
+
+def downloads_header(count: int) -> str:
+    return f"@everyone\n**Downloaded songs : **\n{count} tracks successfully downloaded"
+
+
+def errors_header(count: int) -> str:
+    return "**Errors when downloading songs : **\n@everyone"
+
+
+def pack_messages(title: str, lines: list[str], color: int, header=None) -> list:
+    """Packs lines into as few webhook payloads as Discord's limits allow."""
+    reserve = len(header(10**6)) + 1 if header else 0
+    messages = []
+    message = [[]]
+    embed_size = reserve
+    message_size = len(title) + reserve
+    for line in lines:
+        line = " ".join(str(line).split())[:LINE_LIMIT]
+        size = len(line) + 1
+        if embed_size + size > DESCRIPTION_LIMIT:
+            if (
+                len(message) == EMBEDS_LIMIT
+                or message_size + len(title) + size > MESSAGE_LIMIT
+            ):
+                messages.append(message)
+                message = [[]]
+                embed_size = reserve
+                message_size = len(title) + reserve
+            else:
+                message.append([])
+                embed_size = 0
+                message_size += len(title)
+        elif message_size + size > MESSAGE_LIMIT:
+            messages.append(message)
+            message = [[]]
+            embed_size = reserve
+            message_size = len(title) + reserve
+        message[-1].append(line)
+        embed_size += size
+        message_size += size
+    if message[0]:
+        messages.append(message)
+    payloads = []
+    for message in messages:
+        count = sum(len(embed) for embed in message)
+        embeds = []
+        for i, embed in enumerate(message):
+            description = "\n".join(embed)
+            if i == 0 and header:
+                description = f"{header(count)}\n{description}"
+            embeds.append({"title": title, "description": description, "color": color})
+        payloads.append({"content": None, "embeds": embeds})
+    return payloads
+
+
+class DiscordNotifier:
+    def __init__(self, webhook_url: str, download_log, interval=BATCH_INTERVAL):
+        self.webhook_url = webhook_url
+        self.interval = interval
+        self._download_log = download_log
+        self._events = queue.Queue()
+        self._not_before = 0.0
+        # Set by close() once it stops waiting, the download log is closed
+        # right after and must not be touched by this thread any more.
+        self._abandoned = False
+        self._log_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="discord", daemon=True)
+        self._thread.start()
+
+    def notify(self, kind: str, line) -> None:
+        # Never blocks, the queue is unbounded and only the notifier thread
+        # talks to Discord.
+        self._events.put((kind, line))
+
+    def _with_log(self, fn, *args):
+        with self._log_lock:
+            if self._abandoned:
+                return None
+            return fn(*args)
+
+    def _store(self, events: list) -> None:
+        downloaded = [line for kind, line in events if kind == DOWNLOADED]
+        errors = [line for kind, line in events if kind == ERROR]
+        payloads = pack_messages(
+            "SpotiLoader Downloads", downloaded, SUCCESS_COLOR, downloads_header
+        )
+        payloads += pack_messages(
+            "SpotiLoader Errors", errors, ERROR_COLOR, errors_header
+        )
+        for kind, lines in events:
+            if kind == REPORT:
+                payloads += pack_messages(
+                    "SpotiLoader Performance", lines, REPORT_COLOR
+                )
+        # Written down before sending, so a crash or a Discord outage only
+        # delays them until the next run.
+        if payloads:
+            self._with_log(
+                self._download_log.queue_notifications,
+                [json.dumps(payload) for payload in payloads],
+            )
+
+    def _rate_limit(self, response) -> None:
+        if response.status_code == 429:
+            delay = client.retry_after_delay(response) or RETRY_INTERVAL
+        elif response.headers.get("X-RateLimit-Remaining") == "0":
+            delay = float(response.headers.get("X-RateLimit-Reset-After", 0))
+        else:
+            return
+        self._not_before = time.monotonic() + delay
+
+    def _send(self, payload: str) -> bool:
+        """Returns False if the payload should be tried again later."""
+        delay = self._not_before - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            response = client.post(
+                self.webhook_url,
+                headers={"Content-Type": "application/json"},
+                data=payload,
+            )
+        except requests.RequestException as e:
+            logger.warning(f"Failed to send Discord notification: {e}")
+            return False
+        self._rate_limit(response)
+        if response.status_code == 429 or response.status_code >= 500:
+            logger.warning(
+                f"Discord notification deferred: HTTP {response.status_code}"
+            )
+            return False
+        if response.status_code >= 400:
+            # Retrying a payload Discord refused would block the queue forever.
+            logger.error(
+                f"Discord rejected notification: HTTP {response.status_code} "
+                f"{response.text}"
+            )
+        return True
+
+    def _drain(self) -> None:
+        pending = self._with_log(self._download_log.pending_notifications) or []
+        for notification_id, payload in pending:
+            if self._abandoned or not self._send(payload):
+                return
+            self._with_log(self._download_log.remove_notification, notification_id)
+
+    def _run(self) -> None:
+        # Whatever an earlier run could not deliver goes out first.
+        self._drain()
+        batch = []
+        deadline = None
+        while not self._abandoned:
+            if deadline is None:
+                timeout = RETRY_INTERVAL
+            else:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+            if event is _CLOSE:
+                self._store(batch)
+                self._drain()
+                return
+            if event is not None:
+                batch.append(event)
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+                if time.monotonic() < deadline:
+                    continue
+            if batch and time.monotonic() >= deadline:
+                self._store(batch)
+                batch = []
+                deadline = None
+            self._drain()
+
+    def close(self, timeout: float = CLOSE_TIMEOUT) -> None:
+        self._events.put(_CLOSE)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            with self._log_lock:
+                self._abandoned = True
+            logger.warning("Discord notifications are still pending, sending next run")
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def configure_notifier(webhook_url: str | None) -> None:
+    global _notifier
+    with _notifier_lock:
+        if webhook_url is not None:
+            _notifier = DiscordNotifier(webhook_url, get_download_log())
+
+
+def notify(kind: str, line) -> None:
+    with _notifier_lock:
+        notifier = _notifier
+    if notifier is not None:
+        notifier.notify(kind, line)
+
+
+def close_notifier() -> None:
+    global _notifier
+    with _notifier_lock:
+        notifier, _notifier = _notifier, None
+    if notifier is not None:
+        notifier.close()
@@ -0,0 +1,106 @@
+import os
+from pathlib import PurePath
+from typing import NamedTuple
+from .template import get_output_template
+from .const import *
+
+NEW = "new"
+
+MISSING = "missing"
+
+
+class PlanEntry(NamedTuple):
+    track_id: str
+    name: str
+    filename: str
+    status: str
+    song: dict
+
+
+class Plan:
+    """Sorts saved tracks into work and no-op using set lookups only.
+
+    The download log and output index are loaded once, so deciding about a
+    track costs no SQLite query, filesystem call or metadata request.
+    """
+
+    def __init__(self, download_log, output_index, output: str):
+        self.output = output
+        self.new = []
+        self.missing = []
+        self.present = []
+        self.collisions = []
+        self._output_index = output_index
+        self._template = get_output_template()
+        self._known = dict(download_log.songs())
+        self._owners = {filename: id for id, filename in self._known.items()}
+        self._targets = {}
+        self._seen = set()
+
+    def _on_disk(self, filename: str) -> bool:
+        return self._output_index.has_file(os.path.join(self.output, filename))
+
+    def add(self, songs: list[dict]) -> list[PlanEntry]:
+        """Plans a page of saved tracks and returns the entries that need work."""
+        work = []
+        for song in songs:
+            track = song[TRACK]
+            if not (track[NAME] and track[ID]) or track[ID] in self._seen:
+                continue
+            self._seen.add(track[ID])
+            stored = self._known.get(track[ID])
+            if stored is not None and self._on_disk(stored):
+                self.present.append(track[ID])
+                continue
+            filename = self._template.render_track(track)
+            entry = PlanEntry(
+                track[ID],
+                PurePath(filename).stem,
+                filename,
+                NEW if stored is None else MISSING,
+                song,
+            )
+            # Only the work list keeps the saved track payload, the plan itself
+            # stays small however large the library is.
+            (self.new if stored is None else self.missing).append(
+                entry._replace(song=None)
+            )
+            # The file will still be written, under a _N suffix, but two tracks
+            # with the same name usually deserve a look.
+            owner = self._targets.setdefault(filename, track[ID])
+            if owner == track[ID] and self._on_disk(filename):
+                owner = self._owners.get(filename)
+            if owner != track[ID]:
+                self.collisions.append((entry._replace(song=None), owner))
+            work.append(entry)
+        return work
+
+    def orphaned(self) -> list[tuple[str, str]]:
+        # Only meaningful once the whole library was listed.
+        return [
+            (id, filename)
+            for id, filename in self._known.items()
+            if id not in self._seen
+        ]
+
+    def summary(self) -> str:
+        return (
+            f"{len(self._seen)} tracks: {len(self.new)} new, "
+            f"{len(self.missing)} missing on disk, {len(self.present)} present, "
+            f"{len(self.collisions)} name collisions"
+        )
+
+    def format(self, full_sync: bool = True) -> list[str]:
+        lines = [self.summary()]
+        lines += [f"new: {entry.name} ({entry.track_id})" for entry in self.new]
+        lines += [f"missing: {entry.name} ({entry.track_id})" for entry in self.missing]
+        lines += [
+            f"collision: {entry.filename} ({entry.track_id}) is taken by "
+            f"{owner or 'a file not in the download log'}"
+            for entry, owner in self.collisions
+        ]
+        if full_sync:
+            lines += [
+                f"orphaned: {filename} ({id})" for id, filename in self.orphaned()
+            ]
+        return lines
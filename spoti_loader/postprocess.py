@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from . import metrics
+from .const import DEFAULT_FORMAT
+
+# Queued or running tracks per worker process, a download thread that finished
+# its transfer waits for a slot beyond that.
+QUEUE_PER_WORKER = 2
+
+
+class PostProcessor:
+    """Converts and tags transferred tracks in worker processes.
+
+    Encoding and mutagen both hold the GIL for the whole track, in processes
+    they use every core while the download threads keep streaming. At most
+    capacity tracks are queued or running, so when encoding falls behind the
+    network, transfers wait instead of leaving unprocessed files on disk.
+    With workers set to 0 the work runs in the calling thread.
+    """
+
+    def __init__(self, download_format: str = DEFAULT_FORMAT, workers: int = None):
+        self.download_format = download_format
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.capacity = self.workers * QUEUE_PER_WORKER
+        self._slots = threading.BoundedSemaphore(max(1, self.capacity))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs download and SQLite threads can
+                # copy a held lock into the child, spawned workers start clean.
+                # Ctrl-C reaches the whole process group, the workers ignore it
+                # so the tracks in flight still finish when the daemon stops.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=signal.signal,
+                    initargs=(signal.SIGINT, signal.SIG_IGN),
+                )
+            return self._executor
+
+    def run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        with metrics.timed("postprocess_wait"):
+            self._slots.acquire()
+        try:
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A worker died, the next track gets a fresh pool.
+                with self._lock:
+                    if self._executor is executor:
+                        self._executor = None
+                executor.shutdown(wait=False)
+                raise ValueError("Post-processing worker exited unexpectedly")
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+_postprocessor = None
+_postprocessor_lock = threading.Lock()
+
+
+def configure_postprocessor(
+    download_format: str = DEFAULT_FORMAT, workers: int = None
+) -> None:
+    global _postprocessor
+    with _postprocessor_lock:
+        _postprocessor = PostProcessor(download_format, workers)
+
+
+def get_postprocessor() -> PostProcessor:
+    global _postprocessor
+    with _postprocessor_lock:
+        if _postprocessor is None:
+            _postprocessor = PostProcessor()
+        return _postprocessor
+
+
+def close_postprocessor() -> None:
+    global _postprocessor
+    with _postprocessor_lock:
+        postprocessor, _postprocessor = _postprocessor, None
+    if postprocessor is not None:
+        postprocessor.close()
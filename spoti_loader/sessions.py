@@ -0,0 +1,99 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPool:
+    def __init__(self, factory, size: int = 1, session=None):
+        self.size = size
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._sessions = []
+        if session is not None:
+            self._sessions.append(session)
+            self._idle.put(session)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        # Sessions are only logged in once every existing one is busy, so a
+        # run that never overlaps two loads keeps a single login.
+        with self._lock:
+            create = len(self._sessions) < self.size
+            if create:
+                self._sessions.append(None)
+        if not create:
+            return self._idle.get()
+        try:
+            session = self._factory()
+        except Exception:
+            with self._lock:
+                self._sessions.remove(None)
+            raise
+        with self._lock:
+            self._sessions[self._sessions.index(None)] = session
+        return session
+
+    def _replace(self, session):
+        try:
+            session.reconnect()
+            return session
+        except Exception as e:
+            logger.warning(f"Reconnecting session failed, logging in again: {e}")
+        new_session = self._factory()
+        try:
+            session.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._sessions[self._sessions.index(session)] = new_session
+        return new_session
+
+    def _healthy(self, session):
+        try:
+            if session.is_valid():
+                return session
+        except Exception:
+            pass
+        return self._replace(session)
+
+    @contextmanager
+    def lease(self):
+        session = self._acquire()
+        try:
+            session = self._healthy(session)
+            try:
+                yield session
+            except Exception:
+                session = self._healthy(session)
+                raise
+        finally:
+            # Even if reconnecting failed the slot goes back, the next lease
+            # checks it again.
+            self._idle.put(session)
+
+    def run(self, fn):
+        """Calls fn with a leased session, retrying once on failure."""
+        try:
+            with self.lease() as session:
+                return fn(session)
+        except Exception as e:
+            logger.warning(f"Session request failed, retrying: {e}")
+        with self.lease() as session:
+            return fn(session)
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = [session for session in self._sessions if session is not None]
+            self._sessions = []
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
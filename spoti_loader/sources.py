@@ -0,0 +1,266 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .utils import get_with_token
+from . import metrics
+from .const import *
+
+SAVED_SOURCE = "saved"
+
+PLAYLISTS_SOURCE = "playlists"
+
+ARTISTS_SOURCE = "artists"
+
+SOURCES = (SAVED_SOURCE, PLAYLISTS_SOURCE, ARTISTS_SOURCE)
+
+DEFAULT_PAGE_WORKERS = 4
+
+SAVED_TRACKS_LIMIT = 50
+
+PLAYLISTS_LIMIT = 50
+
+PLAYLIST_TRACKS_LIMIT = 100
+
+FOLLOWED_ARTISTS_LIMIT = 50
+
+ARTIST_ALBUMS_LIMIT = 50
+
+ARTIST_ALBUM_GROUPS = "album,single"
+
+# The Several Albums endpoint accepts at most 20 comma separated IDs.
+ALBUMS_BATCH_SIZE = 20
+
+PLAYLIST_SNAPSHOT = "playlist_snapshot:"
+
+ARTIST_ALBUMS = "artist_albums:"
+
+
+def is_track_item(item) -> bool:
+    track = item.get(TRACK)
+    return (
+        bool(track)
+        and track.get(TYPE, TRACK) == TRACK
+        and not item.get(IS_LOCAL)
+        and bool(track.get(ID))
+    )
+
+
+class LibrarySources:
+    """Lists the tracks of the saved library, playlists and followed artists.
+
+    Every source yields pages of saved-track shaped items, {"track": {...}}, so
+    they all go through the same plan, which keeps each track ID once.
+    """
+
+    def __init__(
+        self,
+        token,
+        download_log,
+        workers: int = DEFAULT_PAGE_WORKERS,
+        full_sync: bool = True,
+    ):
+        self.full_sync = full_sync
+        self._token = token
+        self._download_log = download_log
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pages"
+        )
+        self._state = {}
+
+    def _get(self, stage: str, url: str, **params) -> dict:
+        with metrics.timed(stage):
+            return get_with_token(self._token, url, params=params).json()
+
+    def _fetch_all(self, stage: str, calls):
+        # Up to workers requests are in flight, responses come back in order.
+        window = deque()
+        for url, params in calls:
+            window.append(self._executor.submit(self._get, stage, url, **params))
+            if len(window) >= self._workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+    def _paged(self, stage: str, url: str, limit: int, **params):
+        # The first page tells the total, the others are fetched in parallel.
+        first = self._get(stage, url, limit=limit, offset=0, **params)
+        yield first
+        yield from self._fetch_all(
+            stage,
+            (
+                (url, {LIMIT: limit, OFFSET: offset, **params})
+                for offset in range(limit, first.get(TOTAL) or 0, limit)
+            ),
+        )
+
+    def saved_tracks(self, since: str | None = None):
+        if since is None:
+            for resp in self._paged(
+                "saved_tracks_page",
+                SAVED_TRACKS_URL,
+                SAVED_TRACKS_LIMIT,
+                market="from_token",
+            ):
+                if resp[ITEMS]:
+                    yield resp[ITEMS]
+            return
+        offset = 0
+        while True:
+            resp = self._get(
+                "saved_tracks_page",
+                SAVED_TRACKS_URL,
+                limit=SAVED_TRACKS_LIMIT,
+                offset=offset,
+                market="from_token",
+            )
+            offset += SAVED_TRACKS_LIMIT
+            # Saved tracks are returned newest first, so everything after the
+            # first item older than the cursor was seen by a previous sync.
+            page = [song for song in resp[ITEMS] if song[ADDED_AT] >= since]
+            if page:
+                yield page
+            if len(page) < len(resp[ITEMS]) or len(resp[ITEMS]) < SAVED_TRACKS_LIMIT:
+                break
+
+    def playlist_tracks(self):
+        playlists = []
+        for resp in self._paged("playlists_page", USER_PLAYLISTS_URL, PLAYLISTS_LIMIT):
+            for playlist in resp[ITEMS]:
+                if playlist is None:
+                    continue
+                key = PLAYLIST_SNAPSHOT + playlist[ID]
+                # A playlist whose snapshot did not change has the same tracks
+                # as on the last sync.
+                if (
+                    not self.full_sync
+                    and self._download_log.get_state(key) == playlist[SNAPSHOT_ID]
+                ):
+                    continue
+                self._state[key] = playlist[SNAPSHOT_ID]
+                playlists.append(playlist)
+        # Every page of every playlist is known from the listing, so they are
+        # all fetched through the same window.
+        calls = (
+            (
+                f"{PLAYLIST_URL}{playlist[ID]}/tracks",
+                {LIMIT: PLAYLIST_TRACKS_LIMIT, OFFSET: offset, MARKET: "from_token"},
+            )
+            for playlist in playlists
+            for offset in range(0, playlist[TRACKS][TOTAL], PLAYLIST_TRACKS_LIMIT)
+        )
+        for resp in self._fetch_all("playlist_tracks_page", calls):
+            page = [item for item in resp[ITEMS] if is_track_item(item)]
+            if page:
+                yield page
+
+    def _followed_artists(self) -> list[str]:
+        artists = []
+        params = {LIMIT: FOLLOWED_ARTISTS_LIMIT}
+        while True:
+            resp = self._get("followed_artists_page", FOLLOWED_ARTISTS_URL, **params)
+            artists += [artist[ID] for artist in resp[ARTISTS][ITEMS] if artist]
+            after = (resp[ARTISTS].get(CURSORS) or {}).get(AFTER)
+            if not after:
+                return artists
+            params[AFTER] = after
+
+    def _album_items(self, album) -> list[dict]:
+        # Album tracks are simplified, the album they belong to is added back
+        # so they are complete enough to skip the /v1/tracks lookup.
+        info = {
+            NAME: album[NAME],
+            RELEASE_DATE: album[RELEASE_DATE],
+            IMAGES: album[IMAGES],
+        }
+        tracks = album[TRACKS]
+        items = []
+        while True:
+            items += [
+                {TRACK: {**track, ALBUM: info}}
+                for track in tracks[ITEMS]
+                if track and track.get(ID)
+            ]
+            if not tracks.get(NEXT):
+                return items
+            tracks = self._get("albums_page", tracks[NEXT])
+
+    def artist_tracks(self):
+        artists = self._followed_artists()
+        album_ids = []
+        params = {
+            INCLUDE_GROUPS: ARTIST_ALBUM_GROUPS,
+            LIMIT: ARTIST_ALBUMS_LIMIT,
+            MARKET: "from_token",
+        }
+        calls = (
+            (f"{ARTISTS_URL}/{artist_id}/albums", {OFFSET: 0, **params})
+            for artist_id in artists
+        )
+        for artist_id, resp in zip(
+            artists, self._fetch_all("artist_albums_page", calls)
+        ):
+            key = ARTIST_ALBUMS + artist_id
+            total = str(resp[TOTAL])
+            # Without a snapshot, an unchanged album count has to do.
+            if not self.full_sync and self._download_log.get_state(key) == total:
+                continue
+            self._state[key] = total
+            album_ids += [album[ID] for album in resp[ITEMS] if album]
+            more = (
+                (f"{ARTISTS_URL}/{artist_id}/albums", {OFFSET: offset, **params})
+                for offset in range(
+                    ARTIST_ALBUMS_LIMIT, resp[TOTAL], ARTIST_ALBUMS_LIMIT
+                )
+            )
+            for page in self._fetch_all("artist_albums_page", more):
+                album_ids += [album[ID] for album in page[ITEMS] if album]
+        album_ids = list(dict.fromkeys(album_ids))
+        calls = (
+            (
+                ALBUMS_URL,
+                {
+                    IDS: ",".join(album_ids[i : i + ALBUMS_BATCH_SIZE]),
+                    MARKET: "from_token",
+                },
+            )
+            for i in range(0, len(album_ids), ALBUMS_BATCH_SIZE)
+        )
+        for resp in self._fetch_all("albums_page", calls):
+            page = [
+                item
+                for album in resp[ALBUMS]
+                if album is not None
+                for item in self._album_items(album)
+            ]
+            if page:
+                yield page
+
+    def pages(self, sources=(SAVED_SOURCE,), since: str | None = None):
+        """Yields (source, page) for every source in turn."""
+        for source in sources:
+            if source == SAVED_SOURCE:
+                pages = self.saved_tracks(since)
+            elif source == PLAYLISTS_SOURCE:
+                pages = self.playlist_tracks()
+            elif source == ARTISTS_SOURCE:
+                pages = self.artist_tracks()
+            else:
+                raise ValueError(f"Unknown source: {source}")
+            for page in pages:
+                yield source, page
+
+    def commit(self) -> None:
+        # Snapshots are only stored after a clean run, like the saved tracks
+        # cursor, so a failed track is retried next time.
+        for key, value in self._state.items():
+            self._download_log.set_state(key, value)
+        self._state = {}
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
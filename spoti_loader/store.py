@@ -0,0 +1,260 @@
+import json
+import sqlite3
+import threading
+import time
+from .utils import get_log_db
+from . import metrics
+
+SQLITE_MAX_PARAMS = 500
+
+
+class DownloadLog:
+    def __init__(self, path: str):
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS songs (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                    directory TEXT,
+                    name TEXT,
+                    size INTEGER,
+                    mtime REAL,
+                    PRIMARY KEY (directory, name)
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS artists (
+                    id TEXT PRIMARY KEY,
+                    genres TEXT,
+                    fetched_at REAL
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS lyrics (
+                    id TEXT PRIMARY KEY,
+                    retry_after REAL
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS partials (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT,
+                    offset INTEGER,
+                    size INTEGER
+            );"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS notifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT,
+                    created_at REAL
+            );"""
+        )
+        self._conn.commit()
+        self._ids = {
+            row[0] for row in self._conn.execute("SELECT id FROM songs;").fetchall()
+        }
+        self._lyrics_retry_after = dict(
+            self._conn.execute("SELECT id, retry_after FROM lyrics;").fetchall()
+        )
+
+    def __contains__(self, song_id: str) -> bool:
+        with self._lock:
+            return song_id in self._ids
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._ids)
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            return set(self._ids)
+
+    def add(self, song_id: str, filename: str) -> None:
+        # Written through: with WAL and synchronous=NORMAL one insert is cheap,
+        # and a song that is on disk but not in the log after a kill would be
+        # downloaded again under a _1 name.
+        with self._lock:
+            self._ids.add(song_id)
+            with metrics.timed("sqlite_insert"), self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO songs (id, filename) VALUES (?, ?);",
+                    (song_id, filename),
+                )
+
+    def remove(self, song_id: str) -> None:
+        with self._lock:
+            self._ids.discard(song_id)
+            with self._conn:
+                self._conn.execute("DELETE FROM songs WHERE id = ?;", (song_id,))
+
+    def songs(self) -> list[tuple[str, str]]:
+        with self._lock:
+            return self._conn.execute("SELECT id, filename FROM songs;").fetchall()
+
+    def get_lyrics_retry_after(self, song_id: str) -> float | None:
+        with self._lock:
+            return self._lyrics_retry_after.get(song_id)
+
+    def set_lyrics_retry_after(self, song_id: str, retry_after: float | None) -> None:
+        with self._lock:
+            if retry_after is None and song_id not in self._lyrics_retry_after:
+                return
+            with self._conn:
+                if retry_after is None:
+                    self._lyrics_retry_after.pop(song_id)
+                    self._conn.execute("DELETE FROM lyrics WHERE id = ?;", (song_id,))
+                else:
+                    self._lyrics_retry_after[song_id] = retry_after
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO lyrics VALUES (?, ?);",
+                        (song_id, retry_after),
+                    )
+
+    def get_partial(self, song_id: str) -> tuple[str, int, int] | None:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT filename, offset, size FROM partials WHERE id = ?;", (song_id,)
+            ).fetchone()
+
+    def set_partial(self, song_id: str, filename: str, offset: int, size: int) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?);",
+                    (song_id, filename, offset, size),
+                )
+
+    def remove_partial(self, song_id: str) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM partials WHERE id = ?;", (song_id,))
+
+    def queue_notifications(self, payloads: list[str]) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO notifications (payload, created_at) VALUES (?, ?);",
+                    [(payload, time.time()) for payload in payloads],
+                )
+
+    def pending_notifications(self) -> list[tuple[int, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, payload FROM notifications ORDER BY id;"
+            ).fetchall()
+
+    def remove_notification(self, notification_id: int) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM notifications WHERE id = ?;", (notification_id,)
+                )
+
+    def get_state(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM sync_state WHERE key = ?;", (key,)
+            ).fetchone()
+            return row[0] if row else None
+
+    def set_state(self, key: str, value: str) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?);",
+                    (key, value),
+                )
+
+    def load_file_index(self) -> tuple[dict, dict]:
+        with self._lock:
+            directories = dict(
+                self._conn.execute("SELECT path, mtime FROM directories;").fetchall()
+            )
+            files = {}
+            for directory, name, size, mtime in self._conn.execute(
+                "SELECT directory, name, size, mtime FROM files;"
+            ):
+                files.setdefault(directory, {})[name] = (size, mtime)
+            return directories, files
+
+    def save_file_index(self, directories: dict) -> None:
+        with self._lock:
+            with self._conn:
+                for directory, (mtime, files) in directories.items():
+                    self._conn.execute(
+                        "DELETE FROM files WHERE directory = ?;", (directory,)
+                    )
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO directories VALUES (?, ?);",
+                        (directory, mtime),
+                    )
+                    self._conn.executemany(
+                        "INSERT INTO files VALUES (?, ?, ?, ?);",
+                        [(directory, name, *entry) for name, entry in files.items()],
+                    )
+
+    def get_artists(self, artist_ids: list[str], min_fetched_at: float) -> dict:
+        artists = {}
+        with self._lock:
+            for i in range(0, len(artist_ids), SQLITE_MAX_PARAMS):
+                batch = artist_ids[i : i + SQLITE_MAX_PARAMS]
+                rows = self._conn.execute(
+                    f"SELECT id, genres, fetched_at FROM artists WHERE fetched_at >= ? "
+                    f"AND id IN ({','.join('?' * len(batch))});",
+                    (min_fetched_at, *batch),
+                ).fetchall()
+                artists.update({row[0]: (json.loads(row[1]), row[2]) for row in rows})
+        return artists
+
+    def save_artists(self, artists: dict) -> None:
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO artists VALUES (?, ?, ?);",
+                    [(id, json.dumps(genres), now) for id, genres in artists.items()],
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_download_log = None
+_download_log_lock = threading.Lock()
+
+
+def get_download_log() -> DownloadLog:
+    global _download_log
+    with _download_log_lock:
+        if _download_log is None:
+            _download_log = DownloadLog(get_log_db())
+        return _download_log
+
+
+def close_download_log() -> None:
+    global _download_log
+    with _download_log_lock:
+        if _download_log is not None:
+            _download_log.close()
+            _download_log = None
@@ -0,0 +1,112 @@
+import string
+import threading
+from .metadata import TrackInfo
+from .utils import fix_filename
+from .const import *
+
+DEFAULT_OUTPUT_TEMPLATE = "{artist} - {song_name}.{ext}"
+
+FIELDS = (
+    "artist",
+    "album",
+    "song_name",
+    "release_year",
+    "disc_number",
+    "track_number",
+    "id",
+    "track_id",
+    "ext",
+)
+
+
+class OutputTemplate:
+    """Renders output paths relative to the output directory.
+
+    The template is parsed once, rendering a track only joins its literal
+    parts with the sanitized fields. A / in the template creates directories,
+    a / in a field is replaced like any other character a filename cannot hold.
+    """
+
+    def __init__(
+        self,
+        template: str = DEFAULT_OUTPUT_TEMPLATE,
+        ext: str = EXT_MAP[DEFAULT_FORMAT],
+    ):
+        self.template = template
+        self.ext = ext
+        self._parts = []
+        try:
+            parsed = list(string.Formatter().parse(template))
+        except ValueError as e:
+            raise ValueError(f"Invalid output template {template!r}: {e}")
+        for literal, field, spec, conversion in parsed:
+            if field is not None and field not in FIELDS:
+                raise ValueError(
+                    f"Unknown field {{{field}}} in output template, "
+                    f"expected one of {', '.join(FIELDS)}."
+                )
+            if spec or conversion:
+                raise ValueError(
+                    f"Field {{{field}}} in output template cannot have a format."
+                )
+            self._parts.append((literal, field))
+
+    def render(self, **fields) -> str:
+        parts = []
+        for literal, field in self._parts:
+            parts.append(literal)
+            if field is not None:
+                parts.append(fix_filename(fields[field]))
+        return "".join(parts)
+
+    def render_info(self, info: TrackInfo, track_id: str = None) -> str:
+        return self.render(
+            artist=info.artists[0],
+            album=info.album_name,
+            song_name=info.name,
+            release_year=info.release_year,
+            disc_number=info.disc_number,
+            track_number=info.track_number,
+            id=info.scraped_song_id,
+            track_id=track_id or info.scraped_song_id,
+            ext=self.ext,
+        )
+
+    def render_track(self, track) -> str:
+        """Renders a Web API track object before its metadata is resolved.
+
+        Incomplete tracks are looked up again before download, the file they
+        end up in matches as long as the fields the template uses were there.
+        """
+        album = track.get(ALBUM) or {}
+        return self.render(
+            artist=track[ARTISTS][0][NAME],
+            album=album.get(NAME, ""),
+            song_name=track[NAME],
+            release_year=(album.get(RELEASE_DATE) or "").split("-")[0],
+            disc_number=track.get(DISC_NUMBER, ""),
+            track_number=track.get(TRACK_NUMBER, ""),
+            id=track[ID],
+            track_id=track[ID],
+            ext=self.ext,
+        )
+
+
+_output_template = None
+_output_template_lock = threading.Lock()
+
+
+def configure_output_template(
+    template: str = DEFAULT_OUTPUT_TEMPLATE, ext: str = EXT_MAP[DEFAULT_FORMAT]
+) -> None:
+    global _output_template
+    with _output_template_lock:
+        _output_template = OutputTemplate(template, ext)
+
+
+def get_output_template() -> OutputTemplate:
+    global _output_template
+    with _output_template_lock:
+        if _output_template is None:
+            _output_template = OutputTemplate()
+        return _output_template
@@ -1,22 +1,42 @@
-import requests
+import functools
+import queue
 import re
-import sqlite3
+import threading
+from . import client
+from .auth import TokenProvider
 from .const import LIMIT, OFFSET
 import os
 
+FILENAME_PATTERN = re.compile(
+    r'[/\\:|<>"?*\0-\x1f]|^(AUX|COM[1-9]|CON|LPT[1-9]|NUL|PRN)(?![^.])|^\s|[\s.]$',
+    flags=re.IGNORECASE,
+)
+
+# Artist and album names repeat across a library, most lookups are hits.
+FILENAME_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=FILENAME_CACHE_SIZE)
+def _fix_filename(name: str) -> str:
+    return FILENAME_PATTERN.sub("_", name)
+
 
 def fix_filename(name):
-    return re.sub(
-        r'[/\\:|<>"?*\0-\x1f]|^(AUX|COM[1-9]|CON|LPT[1-9]|NUL|PRN)(?![^.])|^\s|[\s.]$',
-        "_",
-        str(name),
-        flags=re.IGNORECASE,
-    )
+    return _fix_filename(str(name))
+
+
+def get_with_token(token, url, **kwargs):
+    access_token = str(token)
+    response = client.get(url, headers=get_auth_header(access_token), **kwargs)
+    # A TokenProvider can hand out a new token, plain strings cannot.
+    if response.status_code == 401 and isinstance(token, TokenProvider):
+        token.invalidate(access_token)
+        response = client.get(url, headers=get_auth_header(token), **kwargs)
+    return response
 
 
 def invoke_url(token, url):
-    headers = get_auth_header(token)
-    response = requests.get(url, headers=headers)
+    response = get_with_token(token, url)
     responsetext = response.text
     try:
         responsejson = response.json()
@@ -34,33 +54,63 @@ def get_auth_header(token):
     }
 
 
-def get_auth_header_and_params(token, limit, offset):
-    return {
-        "Authorization": f"Bearer {token}",
-        "Accept-Language": "en",
-        "Accept": "application/json",
-        "app-platform": "WebPlayer",
-    }, {LIMIT: limit, OFFSET: offset}
-
-
 def invoke_url_with_params(token, url, limit, offset, **kwargs):
-    headers, params = get_auth_header_and_params(token, limit=limit, offset=offset)
+    params = {LIMIT: limit, OFFSET: offset}
     params.update(kwargs)
-    return requests.get(url, headers=headers, params=params).json()
+    return get_with_token(token, url, params=params).json()
+
+
+def prefetch(iterable, depth: int = 2):
+    """Runs iterable in a background thread, keeping up to depth items ready."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item, error=None) -> bool:
+        # Gives up once the consumer is gone, so the thread never blocks on a
+        # full queue nobody reads.
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(done, e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
 
 
 def get_log_db() -> str:
     xdg_config_home = os.getenv("XDG_CONFIG_HOME")
     if xdg_config_home is None:
         xdg_config_home = os.path.expanduser("~/.config")
-    dbfile = os.path.join(xdg_config_home, "spotiloader", "log.db")
-    conn = sqlite3.connect(dbfile)
-    c = conn.cursor()
-    create_table_query = """CREATE TABLE IF NOT EXISTS songs (
-                                id TEXT PRIMARY KEY,
-                                filename TEXT
-                        );"""
-    c.execute(create_table_query)
-    conn.commit()
-    conn.close()
-    return dbfile
+    return os.path.join(xdg_config_home, "spotiloader", "log.db")
+
+
+def write_atomic(path: str, content: str) -> None:
+    # Readers such as node_exporter may open the file at any moment, so it is
+    # swapped in whole rather than rewritten in place.
+    path = os.path.expanduser(path)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)